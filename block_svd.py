@@ -0,0 +1,108 @@
+import numpy as np
+import os
+from scipy.sparse import issparse
+
+
+def row_blocks(features, batch_rows=100000):
+    """
+    Iterate over a feature matrix a block of rows at a time
+    Params:
+        features.....csr matrix, dense array or fs.LazyCsr
+        batch_rows...rows per block
+    """
+    lazy = hasattr(features, 'select_rows')
+    for start in range(0, features.shape[0], batch_rows):
+        rows = np.arange(start, min(start + batch_rows, features.shape[0]))
+        if lazy:
+            yield features.select_rows(rows).tocsr()
+        else:
+            yield features[start:start + batch_rows]
+
+
+def gram_product(features, Q, batch_rows=100000):
+    """
+    X^T X Q accumulated over row blocks of X
+    Params:
+        features.....feature matrix X
+        Q............dense d x l matrix
+        batch_rows...rows per block
+    """
+    Z = np.zeros(Q.shape)
+    for block in row_blocks(features, batch_rows):
+        Z += block.T.dot(block.dot(Q))
+    return Z
+
+
+def fit_block_svd(features, n_components, n_oversamples=10, n_iter=5, batch_rows=100000, random_state=42):
+    """
+    Randomized truncated SVD whose every pass reads the matrix one block of
+    rows at a time, so X is never densified or copied as a whole. Subspace
+    iteration on X^T X finds the top right singular vectors.
+    Params:
+        features........csr matrix, dense array or fs.LazyCsr
+        n_components....number of components
+        n_oversamples...extra random directions for accuracy
+        n_iter..........power iterations, each one pass over the rows
+        batch_rows......rows per block
+        random_state....seed of the random starting directions
+    Returns:
+        n_components x d components, as TruncatedSVD.components_, and the
+        singular values
+    """
+    d = features.shape[1]
+    l = min(n_components + n_oversamples, d)
+    rng = np.random.RandomState(random_state)
+    Q, _ = np.linalg.qr(rng.normal(size=(d, l)))
+    for x in range(n_iter):
+        Q, _ = np.linalg.qr(gram_product(features, Q, batch_rows))
+
+    # Rayleigh-Ritz: eigenvectors of Q^T X^T X Q rotate Q onto the singular vectors
+    C = np.zeros((l, l))
+    for block in row_blocks(features, batch_rows):
+        B = np.asarray(block.dot(Q))
+        C += B.T.dot(B)
+    evals, evecs = np.linalg.eigh(C)
+    order = np.argsort(evals)[::-1][:n_components]
+    components = Q.dot(evecs[:, order]).T
+    return components, np.sqrt(np.maximum(evals[order], 0))
+
+
+def transform_blocks(features, components, batch_rows=100000):
+    """
+    Project a feature matrix onto components a block of rows at a time
+    Params:
+        features.....csr matrix, dense array or fs.LazyCsr
+        components...n_components x d components
+        batch_rows...rows per block
+    Returns:
+        N x n_components float32 array
+    """
+    reduced = np.empty((features.shape[0], components.shape[0]), dtype=np.float32)
+    start = 0
+    for block in row_blocks(features, batch_rows):
+        reduced[start:start + block.shape[0]] = block.dot(components.T)
+        start += block.shape[0]
+    return reduced
+
+
+def load_or_fit(path, features, n_components, batch_rows=100000):
+    """
+    Load components saved at path, or fit and save them
+    Params:
+        path...........save path of the components
+        features.......feature matrix to fit on
+        n_components...number of components
+        batch_rows.....rows per block
+    Returns:
+        Components and singular values
+    """
+    if os.path.exists(path):
+        print "Using cached SVD components", path
+        loader = np.load(path)
+        return loader['components'], loader['singular_values']
+    components, singular_values = fit_block_svd(features, n_components, batch_rows=batch_rows)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    np.savez(path, components=components, singular_values=singular_values)
+    print "Saved SVD components to", path
+    return components, singular_values
@@ -7,52 +7,136 @@ import logging
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split, StratifiedKFold
-from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.metrics import accuracy_score
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 from xgboost import XGBClassifier
 from scipy.sparse import csr_matrix, hstack, vstack
-from sklearn.decomposition import TruncatedSVD
 from memory_profiler import memory_usage
 from lightgbm import LGBMClassifier
 import plot_cm as pcm
+import feature_store as fs
+import topk
+import stream_train
+import block_svd
 import argparse
+import json
+import os
 from collections import Counter
+from multiprocessing import Pool
+from preprocess import num_workers
+import tempfile
+import shutil
 
 
-def cross_validation_accuracy(clf, X, labels, skf, m):
+def set_threads(clf, threads):
+    """ 
+    Set the thread count of a classifier, whichever parameter name it uses
+    Params:
+        clf.......A classifier.
+        threads...Number of threads
+    """
+    params = clf.get_params()
+    for key in ['n_jobs', 'nthread']:
+        if params.get(key) is not None:
+            clf.set_params(**{key: threads})
+
+
+def fit_predict(clf, m, X_train, X_test, y_train, y_test, data_path=None, train_index=None, test_index=None):
+    """ 
+    Fit a classifier and predict the class probabilities of both splits.
+    Boosters given a cached dataset train on its train_index rows
+    instead of converting X_train again.
+    Params:
+        clf...........A classifier.
+        m.............The model name
+        X_train.......Training features
+        X_test........Validation features
+        y_train.......Training labels
+        y_test........Validation labels
+        data_path.....Cached dataset from stream_train.cache_dataset
+        train_index...Rows of the cached dataset to train on
+        test_index....Rows of the cached dataset to validate on
+    Returns:
+        Fitted model, validation probabilities, training probabilities and
+        the class of each probability column
+    """
+    if data_path is not None:
+        num_class = int(max(y_train.max(), y_test.max())) + 1
+        bst = stream_train.train_cached(clf, m, data_path, train_index, test_index,
+                                        num_class, X_train.shape[1])
+        probs = stream_train.predict_rows(bst, m, X_test)
+        train_probs = stream_train.predict_rows(bst, m, X_train)
+        return bst, probs, train_probs, np.arange(num_class)
+
+    if m == 'RandomForest' or m == 'Regression':
+        clf.fit(X_train, y_train)
+    else:
+        clf.fit(X_train, y_train,
+                eval_set=[(X_train, y_train), (X_test, y_test)],
+                early_stopping_rounds=2,
+                verbose=False,)
+    return clf, clf.predict_proba(X_test), clf.predict_proba(X_train), clf.classes_
+
+
+def fit_fold(fold):
+    """ 
+    Train and score one cross-validation fold in a worker process
+    Params:
+        fold...classifier, model name, memory mapped feature path, labels,
+               train indices, test indices, thread budget and cached dataset
+    Returns:
+        Top 1 validation accuracy, training accuracy and top 5 validation accuracy
+    """
+    clf, m, path, labels, train_index, test_index, threads, data_path = fold
+    set_threads(clf, threads)
+    X = fs.load_features(path)
+    X_train, X_test = X[train_index], X[test_index]
+    y_train, y_test = labels[train_index], labels[test_index]
+    clf, probs, train_probs, classes = fit_predict(clf, m, X_train, X_test, y_train, y_test,
+                                                   data_path, train_index, test_index)
+    t5, score = top_5_accuracy(probs, y_test)
+    train_pred = classes[np.argmax(train_probs, axis=1)]
+    train_score = accuracy_score(y_train, train_pred)
+
+    return score, train_score, t5
+
+
+def cross_validation_accuracy(clf, X, labels, skf, m, workers=0, data_path=None):
     """ 
     Compute the average testing accuracy over k folds of cross-validation. 
+    Folds train concurrently in a process pool, each with an equal share of the
+    cpus as its thread budget, and read their slices from a memory mapped copy
+    of X instead of having it pickled.
     Params:
-        clf......A classifier.
-        X........A matrix of features.
-        labels...The true labels for each instance in X
-        split........The fold indices
-        m............The model name
+        clf.........A classifier.
+        X...........A matrix of features.
+        labels......The true labels for each instance in X
+        skf.........The fold indices
+        m...........The model name
+        workers.....Folds to run at once, 0 for as many as the cpus allow
+        data_path...Cached booster dataset of X, folds are taken from its rows
     Returns:
         The average testing accuracy of the classifier
         over each fold of cross-validation.
     """
-    scores = []
-    train_scores = []
-    t5s = []
-    for train_index, test_index in skf:
-        X_train, X_test = X[train_index], X[test_index]
-        y_train, y_test = labels[train_index], labels[test_index]
-        if m == 'RandomForest' or m == 'Regression':
-            clf.fit(X_train, y_train)
-        else:
-            clf.fit(X_train, y_train,
-                    eval_set=[(X_train, y_train), (X_test, y_test)],
-                    early_stopping_rounds=2,
-                    verbose=False,)
-        probs = clf.predict_proba(X_test)
-        t5, score = top_5_accuracy(probs, y_test)
-        train_pred = clf.predict(X_train)
-        train_score = accuracy_score(y_train, train_pred)
-        scores.append(score)
-        t5s.append(t5)
-        train_scores.append(train_score)
+    cpus = num_workers()
+    workers = min(len(skf), num_workers(workers))
+    threads = max(1, cpus // workers)
+    print "Running %d folds, %d at a time with %d threads each" % (len(skf), workers, threads)
+
+    path = tempfile.mkdtemp(prefix="cv_features.")
+    try:
+        fs.save_features(path, X)
+        folds = [(clf, m, path, labels, train_index, test_index, threads, data_path)
+                 for train_index, test_index in skf]
+        pool = Pool(processes=workers)
+        res = pool.map(fit_fold, folds)
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(path)
+
+    scores, train_scores, t5s = zip(*res)
 
     return np.mean(scores), np.mean(train_scores), np.mean(t5s)
 
@@ -86,12 +170,69 @@ def save_incorrect_csv(probs, y_test, test_idx):
     inc_df.to_csv("results/confs/incorrect_df_" + strftime("%m-%d_%H_%M", gmtime()) + '.csv', index=0, columns=['peg', 'score', 'true_function', 'pred_function', 'counts'])
 
 
-def test_train_split(clf, split, m, class_names):
+def prob_key(m, run=''):
+    """
+    Key of the stored probabilities of a model
+    Params:
+        m......The model name
+        run....Optional run name, kept apart from other runs of the same model
+    """
+    return m if not run else run + '.' + m
+
+
+def store_probs(key, probs, idxs, dtype=np.float32):
+    """
+    Save class probabilities as a binary array whose row r is instance r,
+    under results/probs/<key>
+    Params:
+        key.......model/run key from prob_key
+        probs.....probability matrices of each split
+        idxs......row ids of each split
+        dtype.....float16 or float32
+    """
+    path = "results/probs/" + key
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nrows = sum(len(idx) for idx in idxs)
+    shape = (nrows, probs[0].shape[1])
+    stored = np.lib.format.open_memmap(path + "/probs.npy", mode='w+', dtype=dtype, shape=shape)
+    for p, idx in zip(probs, idxs):
+        stored[np.asarray(idx)] = p
+    stored.flush()
+    del stored
+    with open(path + "/header.json", 'w') as f:
+        json.dump({'key': key, 'shape': shape, 'dtype': np.dtype(dtype).name,
+                   'created': strftime("%m-%d_%H_%M", gmtime())}, f)
+    print "Stored probabilities under key", key
+
+
+def load_probs(key, k=0):
+    """
+    Memory map stored class probabilities
+    Params:
+        key...model/run key from prob_key
+        k.....keep only the k most probable classes of each row, 0 keeps all
+    Returns:
+        float32 csr matrix of probabilities, row r is instance r, as scipy
+        has no float16 sparse support
+    """
+    probs = np.load("results/probs/" + key + "/probs.npy", mmap_mode='r')
+    if k > 0:
+        return topk.top_k_sparse(probs, k)
+    return csr_matrix(probs, dtype=np.float32)
+
+
+def test_train_split(clf, split, m, class_names, prob_dtype=np.float32, run='', data_path=None):
     """
     Compute the accuracy of a train/test split
     Params:
-        clf......A classifier.
-        split....indices
+        clf..........A classifier.
+        split........indices
+        m............The model name
+        class_names..Ordered class names
+        prob_dtype...dtype of the stored probabilities
+        run..........Run name for the stored probabilities key
+        data_path....Cached booster dataset the split rows are taken from
     Returns:
         The testing accuracy and the confusion
         matrix.
@@ -99,29 +240,15 @@ def test_train_split(clf, split, m, class_names):
 
     X_train, X_test, y_train, y_test, train_idx, test_idx = split
 
-    if m == 'RandomForest' or m =='Regression':
-        clf.fit(X_train, y_train)
-    else:
-        clf.fit(X_train, y_train,
-                eval_set=[(X_train, y_train), (X_test, y_test)],
-                early_stopping_rounds=2,
-                verbose=False,)
-
-    probs = clf.predict_proba(X_test)
-    train_probs = clf.predict_proba(X_train)
-    allp = np.vstack([probs, train_probs])
-    idxs = test_idx + train_idx
-    all_probs = [None] * len(idxs)
-    for x in range(len(idxs)):
-        all_probs[x] = allp[idxs[x]]
-    all_probs = np.array(all_probs)
-    np.savetxt('results/stored_probs.csv', all_probs, delimiter=',')
+    clf, probs, train_probs, classes = fit_predict(clf, m, X_train, X_test, y_train, y_test,
+                                                   data_path, train_idx, test_idx)
+    store_probs(prob_key(m, run), [probs, train_probs], [test_idx, train_idx], prob_dtype)
 
     t5, score = top_5_accuracy(probs, y_test)
-    train_pred = clf.predict(X_train)
+    train_pred = classes[np.argmax(train_probs, axis=1)]
     train_score = accuracy_score(y_train, train_pred)
 
-    test_pred = clf.predict(X_test)
+    test_pred = classes[np.argmax(probs, axis=1)]
 
     stats_df, cnfm = pcm.class_statistics(y_test, test_pred, class_names)
     stats_df.to_csv('results/stats/' + m + '.csv', index=0, columns=["PGF", 'Sensitivity', 'Specicifity',
@@ -139,7 +266,7 @@ def test_train_split(clf, split, m, class_names):
     return score, train_score, clf, t5
 
 
-def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_feat):
+def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_feat, cv_workers=0, prob_dtype=np.float32, run='', bin_cache=None):
     """ 
     Compute the average testing accuracy over k folds of cross-validation. 
     Params:
@@ -150,6 +277,11 @@ def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_
         model_names..Readable names of each classifier
         cv...........Whether to use cross validation
         mem..........Whether to store memory usage
+        cv_workers...Cross validation folds to run at once, 0 for as many as fit
+        prob_dtype...dtype of the stored probabilities
+        run..........Run name for the stored probabilities key
+        bin_cache....Directory and dataset key of cached booster datasets for
+                     the boosters, None to convert in every fit
     """
     labels = convert_labels(class_names)
     class_names = unique_class_names(class_names)
@@ -170,8 +302,12 @@ def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_
 
         clf = clfs[x]
 
+        data_path = None
+        if bin_cache is not None and (mn == 'LightGBM' or mn == 'XGBoost'):
+            data_path = stream_train.cache_dataset(clf, mn, features, labels, *bin_cache)
+
         if cv:
-            cv_score, cv_train_score, cv_t5 = cross_validation_accuracy(clf, features, labels, skf, mn)
+            cv_score, cv_train_score, cv_t5 = cross_validation_accuracy(clf, features, labels, skf, mn, cv_workers, data_path)
             print "%s %d fold cross validation mean train accuracy: %f" % (mn, folds, cv_train_score)
             logging.info("%s %d fold cross validation mean train accuracy: %f" % (mn, folds, cv_train_score))
             print "%s %d fold cross validation mean top 5 accuracy: %f" % (mn, folds, cv_t5)
@@ -183,7 +319,7 @@ def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_
             cv_train_score = -1
             cv_t5 = -1
 
-        args = (clf, tts_split, mn, class_names)
+        args = (clf, tts_split, mn, class_names, prob_dtype, run, data_path)
         if mem:
             mem_usage, retval = memory_usage((test_train_split, args), interval=0.5, retval=True)
             tts_score, tts_train_score, clf, t5 = retval
@@ -199,7 +335,10 @@ def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_
             max_mem = -1
 
         if save_feat:
-            feat_score = clf.feature_importances_
+            if data_path is not None:
+                feat_score = stream_train.feature_importances(clf, mn, features.shape[1])
+            else:
+                feat_score = clf.feature_importances_
             sorted_feats = np.argsort(feat_score)[::-1]
             np.savetxt('results/' + mn + strftime("%m-%d_%H_%M", gmtime()) + '.sorted_features', np.vstack((sorted_feats,feat_score[sorted_feats])))
             np.savetxt('results/' + mn + strftime("%m-%d_%H_%M", gmtime()) + '.feat_scores', feat_score)
@@ -220,6 +359,81 @@ def classify_all(class_names, features, clfs, folds, model_names, cv, mem, save_
     return results
 
 
+def classify_streaming(class_names, features, clfs, model_names, prob_dtype=np.float32, run=''):
+    """ 
+    Fit and test the gradient boosting models on the train/test split of
+    classify_all without reading the whole feature matrix into memory. The
+    split rows are streamed to libsvm files that LightGBM and XGBoost load
+    out of core.
+    Params:
+        class_names..The true label for each row of features
+        features.....fs.LazyCsr feature vectors for each instance
+        clfs.........The classifiers to fit and test
+        model_names..Readable names of each classifier
+        prob_dtype...dtype of the stored probabilities
+        run..........Run name for the stored probabilities key
+    Returns:
+        Results table in the format of classify_all
+    """
+    labels = convert_labels(class_names)
+    num_class = len(unique_class_names(class_names))
+    train_idx, test_idx = train_test_split(
+        range(len(labels)), test_size=0.2, random_state=0, stratify=labels)
+
+    results = pd.DataFrame(columns=["Model", "CV Train Acc", "CV Val Acc", "CV T5 Acc", "Split Train Acc", "Split Val Acc", "Top 5 Val Acc", "Max Mem", "Avg Mem", "Time"])
+
+    path = tempfile.mkdtemp(prefix="stream.", dir="data")
+    try:
+        train_file = path + "/train.svm"
+        test_file = path + "/test.svm"
+        print "Streaming %d train and %d test rows to %s" % (len(train_idx), len(test_idx), path)
+        stream_train.write_svmlight(features, labels, train_idx, train_file)
+        stream_train.write_svmlight(features, labels, test_idx, test_file)
+
+        for clf, mn in zip(clfs, model_names):
+            if mn != 'LightGBM' and mn != 'XGBoost':
+                print "Skipping %s, only gradient boosting models train out of core" % mn
+                continue
+            start = time()
+            print "Classiying with", mn
+            logging.info("Classifying out of core with %s", mn)
+
+            bst = stream_train.train_booster(clf, mn, train_file, test_file, num_class, features.shape[1])
+            probs = stream_train.predict_file(bst, mn, test_file)
+            train_probs = stream_train.predict_file(bst, mn, train_file)
+            store_probs(prob_key(mn, run), [probs, train_probs], [test_idx, train_idx], prob_dtype)
+
+            t5, score = top_5_accuracy(probs, labels[test_idx])
+            train_score = accuracy_score(labels[train_idx], np.argmax(train_probs, axis=1))
+
+            print "Top 5 accuracy:", t5
+            print "Training accuracy:", train_score
+            print "Validation accuracy:", score
+            logging.info("Top 5 accuracy: %f", t5)
+            logging.info("Training accuracy: %f", train_score)
+            logging.info("test/train split accuracy: %f", score)
+            elapsed = time() - start
+            print "Time elapsed for model %s is %f" % (mn, elapsed)
+            logging.info("Time elapsed for model %s is %f" % (mn, elapsed))
+            results.loc[results.shape[0]] = ([mn, -1, -1, -1, train_score, score, t5, -1, -1, elapsed])
+    finally:
+        shutil.rmtree(path)
+
+    return results
+
+
+def print_results(results):
+    """ 
+    Print the elapsed times and the results table
+    Params:
+        results...Results table from classify_all
+    """
+    for t in results.Time:
+        print t,
+    print
+    print results.to_string()
+
+
 def unique_class_names(names):
     """ 
     Generate ordered unique class names
@@ -248,16 +462,47 @@ def top_5_accuracy(probs, y_true):
         top5 accuracy
         top1 accuracy
     """
-    top5 = np.argsort(probs, axis=1)[:,-5:]
-    c = 0
-    top1c = 0
-    for x in range(len(top5)):
-        if np.in1d(y_true[x], top5[x], assume_unique=True)[0]:
-            c += 1
-        if y_true[x] == top5[x][4]:
-            top1c += 1
+    top1, top5 = topk.top_k_accuracy(probs, y_true, [1, 5])
 
-    return float(c)/len(y_true), float(top1c)/len(y_true)
+    return top5, top1
+
+
+def grouped_tfidf(features, labels):
+    """ 
+    Tf-idf with document frequencies taken within each class, the same as fitting
+    a TfidfTransformer on the rows of every class, in one pass over the nonzeros
+    Params:
+        features...csr count matrix, its data is rescaled in place
+        labels.....class index of each row
+    Returns:
+        The rescaled, l2 normalized features
+    """
+    labels = labels.astype(np.int64)
+    nrows, ncols = features.shape
+    nclasses = labels.max() + 1
+
+    # Per class document frequencies as (label indicator) x (binarized features),
+    # explicit zeros left by --thresh are not documents
+    indicator = csr_matrix((np.ones(nrows), (labels, np.arange(nrows))), shape=(nclasses, nrows))
+    binary = csr_matrix(((features.data != 0).astype(np.float64), features.indices, features.indptr),
+                        shape=features.shape)
+    df = (indicator * binary).tocoo()
+    df_keys = df.row.astype(np.int64) * ncols + df.col
+    order = np.argsort(df_keys)
+    df_keys = df_keys[order]
+    df_counts = df.data[order]
+
+    row_ids = np.repeat(np.arange(nrows), np.diff(features.indptr))
+    entry_class = labels[row_ids]
+    entry_df = df_counts[np.searchsorted(df_keys, entry_class * ncols + features.indices)]
+    class_sizes = np.bincount(labels, minlength=nclasses)
+
+    # Smoothed idf as in TfidfTransformer, ln((1 + n) / (1 + df)) + 1
+    features.data *= np.log((1. + class_sizes[entry_class]) / (1. + entry_df)) + 1
+    norms = np.sqrt(np.bincount(row_ids, weights=features.data.astype(np.float64) ** 2, minlength=nrows))
+    norms[norms == 0] = 1
+    features.data /= norms[row_ids]
+    return features
 
 
 def convert_labels(labels):
@@ -276,45 +521,34 @@ def convert_labels(labels):
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename)
-    return csr_matrix((loader['data'], loader['indices'], loader['indptr']),
-                         shape=loader['shape'], dtype="float32"), loader['labels']
+    return fs.load_csr(filename)
 
 
-def load_data(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
-    path = "data/" + size + '/'
+def store_paths(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
+    """
+    Feature store of every selected feature set
+    Params:
+        size...data set name
+    Returns:
+        List of store paths
+    """
+    names = [("1", dna1), ("3", dna3), ("5", dna5), ("10", dna10),
+             ("aa1", aa1), ("aa2", aa2), ("aa3", aa3), ("aa4", aa4)]
+    return ["data/" + size + "/feature_matrix." + name + ".csr" for name, use in names if use]
 
+
+def load_data(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
     files = []
-    if dna1:
-        features, labels = load_sparse_csr(path + "feature_matrix.1.csr.npz")
-        files.append(features)
-    if dna3:
-        features, labels = load_sparse_csr(path + "feature_matrix.3.csr.npz")
-        files.append(features)
-    if dna5:
-        features, labels = load_sparse_csr(path + "feature_matrix.5.csr.npz")
-        files.append(features)
-    if dna10:
-        features, labels = load_sparse_csr(path + "feature_matrix.10.csr.npz")
-        files.append(features)
-    if aa1:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa1.csr.npz")
-        files.append(features)
-    if aa2:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa2.csr.npz")
-        files.append(features)
-    if aa3:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa3.csr.npz")
-        files.append(features)
-    if aa4:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa4.csr.npz")
+    for path in store_paths(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
+        features, labels = load_sparse_csr(path)
         files.append(features)
 
     if not files:
         print "No dataset provided"
         exit(0)
 
-    features = hstack(files, format='csr')
+    # Nothing is read yet, row and column selections are applied on tocsr
+    features = fs.LazyCsr(files)
 
     return features, labels
 
@@ -330,19 +564,25 @@ def get_parser():
     parser.add_argument("--aa2", default=False, action='store_true', help="add 2mer aa features")
     parser.add_argument("--aa3", default=False, action='store_true', help="add 3mer aa features")
     parser.add_argument("--aa4", default=False, action='store_true', help="add 4mer aa features")
-    parser.add_argument("--redu", default=0, type=int, help="feature reduction with Truncated SVD")
+    parser.add_argument("--redu", default=0, type=int, help="feature reduction with truncated SVD, components are cached per feature set")
     parser.add_argument("--tfidf", default=False, action='store_true', help="convert counts to tfidf")
     parser.add_argument("--prune", default=0, type=int, help="remove features with apperance below prune")
     parser.add_argument("--est", default=16, type=int, help="number of estimators (trees)")
-    parser.add_argument("--thresh", default=0, type=int, help="zero counts below threshold")
+    parser.add_argument("--thresh", default=0, type=int, help="zero counts below threshold, by magnitude for signed hashed counts")
     parser.add_argument("--cv", default=False, action='store_true', help="calculate cross validation results")
+    parser.add_argument("--cv_workers", default=0, type=int, help="cross validation folds to train at once, 0 for as many as the cpus allow")
     parser.add_argument("--mem", default=False, action='store_true', help="store memory usage statistics")
     parser.add_argument("--trunc", default=0, type=int, help="Use only top k ")
     parser.add_argument("--save_feat", default=False, action='store_true', help="Save features and importances")
-    parser.add_argument("--use_prob", default=False, action='store_true', help="Use prior probabilities as features")
+    parser.add_argument("--use_prob", default=None, type=str, help="Use the stored probabilities of this model/run key as features")
+    parser.add_argument("--prob_topk", default=0, type=int, help="keep only the top k stored probabilities of each row, 0 keeps all")
+    parser.add_argument("--run", default='', type=str, help="run name prefixed to the key of the stored probabilities")
+    parser.add_argument("--prob_dtype", default='float32', choices=['float16', 'float32'], help="dtype of the stored probabilities")
     parser.add_argument("--rf", default=False, action='store_true', help="build random forest model")
     parser.add_argument("--xgb", default=False, action='store_true', help="build xgboost model")
     parser.add_argument("--lgbm", default=False, action='store_true', help="build lightgbm model")
+    parser.add_argument("--no_bin_cache", default=False, action='store_true', help="convert lgbm/xgb features in every fit instead of caching booster datasets")
+    parser.add_argument("--stream", default=False, action='store_true', help="train lgbm/xgb out of core without loading the feature matrix")
     parser.add_argument("--gpu", default=False, action='store_true', help="use gpu for lgbm")
     parser.add_argument("--regr", default=False, action='store_true', help="build regression model")
     parser.add_argument("--thread",  default=-1, type=int, help="specify number of threads to to run with")
@@ -352,6 +592,8 @@ def get_parser():
 def main():
     parser = get_parser()
     args = parser.parse_args()
+    if args.stream and (args.thresh > 0 or args.tfidf or args.redu > 0 or args.cv):
+        parser.error("--stream does not support --thresh, --tfidf, --redu or --cv")
     est = args.est
     thresh = args.thresh
     prune = args.prune
@@ -422,18 +664,11 @@ def main():
         print "Go terms with more than 100 seqs:", len(sig_terms)
         sig_rows = np.array([c in sig_terms for c in class_names])
         print "Seqs labeled with sig term:", sum(sig_rows)
-        features = features[sig_rows, :]
+        features = features.select_rows(sig_rows)
         print features.shape
         class_names = class_names[sig_rows]
         print len(class_names)
 
-    # Zero-out counts below the given threshold
-    if thresh > 0:
-        v = np.sum(features.data <= thresh)
-        print "Values less than threshhold,", v
-        logging.info("Values less than threshhold,", v)
-        features.data *= features.data > thresh
-
     # Remove feature columns that have sample below threshhold
     nonzero_counts = features.getnnz(0)
     nonz = nonzero_counts > int(prune)
@@ -443,39 +678,74 @@ def main():
     logging.info(
         "Removing %d features that do not have more than %s nonzero counts" % (features.shape[1] - np.sum(nonz), prune))
 
-    features = features[:, nonz]
+    features = features.select_columns(nonz)
+    # Marks the count columns, only they are thresholded
+    counts = np.ones(features.shape[1], dtype=bool)
 
     if args.use_prob:
-        probs = np.genfromtxt("results/stored_probs.csv")
-        features = hstack([features, probs])
+        features = features.hstack(load_probs(args.use_prob, args.prob_topk))
+        counts = np.concatenate([counts, np.zeros(features.shape[1] - len(counts), dtype=bool)])
 
     if args.trunc > 0:
         fimp = np.genfromtxt("results/LightGBM.sorted_features")
-        idxs = fimp[0][:args.trunc]
-        features = features[:,idxs]
+        idxs = fimp[0][:args.trunc].astype(int)
+        features = features.select_columns(idxs)
+        counts = counts[idxs]
+
+    # Booster datasets and SVD components are cached by everything that
+    # shapes the features and by the rows used
+    feature_key = [args.data, args.dna1, args.dna3, args.dna5, args.dna10, args.aa1, args.aa2,
+                   args.aa3, args.aa4, prune, args.use_prob, args.prob_topk, args.trunc,
+                   thresh, args.tfidf, [b.nnz for b in features.blocks]]
+    # and by the contents of every file the features are read from
+    stamps = [fs.content_stamp(path) for path in store_paths(args.data, args.dna1, args.dna3, args.dna5,
+                                                             args.dna10, args.aa1, args.aa2, args.aa3, args.aa4)]
+    if args.use_prob:
+        stamps.append(fs.content_stamp("results/probs/" + args.use_prob))
+    rows = np.arange(features.nrows) if features.rows is None else features.rows
+    # Grouped tf-idf depends on the labels as well
+    svd_key = stream_train.dataset_key(feature_key + [stamps], rows, class_names if args.tfidf else None)
+    svd_path = "data/%s/svd/%s.%d.npz" % (args.data, svd_key, args.redu)
+    bin_cache = None
+    if not args.no_bin_cache:
+        bin_cache = ("data/" + args.data + "/binned",
+                     stream_train.dataset_key(feature_key + [args.redu, stamps], rows, class_names))
+
+    if args.stream:
+        print "Training out of core on data shape:", features.shape
+        logging.info("Training out of core on data shape: %s" % (features.shape,))
+        results = classify_streaming(class_names, features, clfs, model_names, args.prob_dtype, args.run)
+        print_results(results)
+        return
+
+    # Only the selected rows and columns are read from the feature files
+    features = features.tocsr()
+
+    # Zero-out counts below the given threshold, explicit zeros are kept so
+    # this does not change the column counts used for pruning above. Hashed
+    # counts are signed, so their magnitude is compared
+    if thresh > 0:
+        low = counts[features.indices] & (features.data <= thresh) & (features.data >= -thresh)
+        v = np.sum(low)
+        print "Values less than threshhold,", v
+        logging.info("Values less than threshhold, %d", v)
+        features.data[low] = 0
+
+    features = features.astype('float32')
 
     if args.tfidf:
         print "Converting features to tfidf"
         logging.info("Converting features to tfidf")
-        tfer = TfidfTransformer()
-        '''tfer.fit(features)
-        features = tfer.transform(features)'''
         labels = convert_labels(class_names)
-        for c in set(labels):
-            idxs = np.where(labels == c)
-            tfer.fit(features[idxs])
-            features[idxs] = tfer.transform(features[idxs])
-
-    features = features.astype('float32')
+        features = grouped_tfidf(features, labels)
 
     # Reduce feature dimensionality
     if args.redu > 0:
-        print "Starting dimensionality reduction via TruncatedSVD"
-        logging.info("Starting dimensionality reduction via TruncatedSVD")
+        print "Starting dimensionality reduction via block randomized SVD"
+        logging.info("Starting dimensionality reduction via block randomized SVD")
         start = time()
-        svd = TruncatedSVD(n_components=int(args.redu), n_iter=5, random_state=42)
-        svd.fit(features)
-        features = svd.transform(features)
+        components, _ = block_svd.load_or_fit(svd_path, features, int(args.redu))
+        features = block_svd.transform_blocks(features, components)
         end = time()
         elapsed = end - start
         print "Time elapsed for dimensionality reduction is %f" % elapsed
@@ -486,13 +756,10 @@ def main():
 
     logging.info("Final data shape: %s" % (features.shape,))
     if args.data=='cafa':
-        results = classify_all(class_names, features, clfs, folds, model_names, args.cv, args.mem, args.save_feat)
+        results = classify_all(class_names, features, clfs, folds, model_names, args.cv, args.mem, args.save_feat, args.cv_workers, args.prob_dtype, args.run, bin_cache)
     else:
-        results = classify_all(class_names, features, clfs, folds, model_names, args.cv, args.mem, args.save_feat)
-    for t in results.Time:
-        print t,
-    print
-    print results.to_string()
+        results = classify_all(class_names, features, clfs, folds, model_names, args.cv, args.mem, args.save_feat, args.cv_workers, args.prob_dtype, args.run, bin_cache)
+    print_results(results)
 
 
 if __name__ == '__main__':
@@ -14,10 +14,294 @@ from scipy.sparse import csr_matrix, hstack, vstack
 from sklearn.decomposition import TruncatedSVD
 from memory_profiler import memory_usage
 from lightgbm import LGBMClassifier
+import lightgbm as lgb
+import xgboost as xgb
 import plot_cm as pcm
+import feature_store as fs
+import stream_train
 import argparse
 from collections import Counter, defaultdict
-from sklearn.multiclass import OneVsRestClassifier
+from sklearn.base import clone
+from multiprocessing import Pool, Queue
+from Queue import Empty
+from preprocess import num_workers, report_progress
+from classify import set_threads
+import cPickle as pickle
+import copy
+import hashlib
+import tempfile
+import shutil
+import os
+
+
+# Read only state of term training workers, set by init_term_worker
+shared = {}
+
+
+def term_batches(terms, cost, nbatches):
+    """
+    Split terms into batches of about equal cost, assigning the most
+    expensive remaining term to the cheapest batch
+    Params:
+        terms......term column indices
+        cost.......training cost of each term, its number of positives
+        nbatches...number of batches
+    Returns:
+        List of term index lists
+    """
+    nbatches = max(1, min(nbatches, len(terms)))
+    batches = [[] for x in range(nbatches)]
+    totals = np.zeros(nbatches)
+    for i in np.argsort(cost, kind='mergesort')[::-1]:
+        b = np.argmin(totals)
+        batches[b].append(terms[i])
+        totals[b] += cost[i] + 1
+    return [b for b in batches if b]
+
+
+def init_term_worker(path, labels, clf, model_dir, threads, started):
+    """
+    Attach a worker to the memory mapped features
+    Params:
+        path........feature path from fs.save_features
+        labels......NxT csc matrix of true terms
+        clf.........unfitted classifier cloned for every term
+        model_dir...directory the term models are saved to
+        threads.....thread budget of each term model
+        started.....Queue the worker announces its pid on
+    """
+    started.put(os.getpid())
+    shared['X'] = fs.load_features(path)
+    shared['labels'] = labels
+    shared['clf'] = clf
+    shared['model_dir'] = model_dir
+    set_threads(clf, threads)
+
+
+def fit_terms(terms):
+    """
+    Train and save the binary model of each term in a batch, a term file is
+    only renamed into place once it is complete
+    Params:
+        terms...term column indices
+    Returns:
+        Number of terms trained
+    """
+    X = shared['X']
+    labels = shared['labels']
+    for t in terms:
+        y = labels[:, t].toarray().ravel()
+        if y.min() == y.max():
+            model = {'constant': float(y[0])}
+        else:
+            model = clone(shared['clf'])
+            model.fit(X, y)
+        save_term(shared['model_dir'], t, model)
+    return len(terms)
+
+
+def run_batches(pool, func, batches, total, workers, started, poll=1.0):
+    """
+    Run batches on a pool and report progress as they finish. A pool replaces
+    a crashed worker and loses its batch, so waiting on the results would hang.
+    Every worker announces its pid when it starts, so more pids than workers
+    means one was replaced and fails the run.
+    Params:
+        pool......Pool whose workers only exit when it is closed
+        func......function of a batch returning the number of items done
+        batches...list of batches
+        total.....number of items in all batches
+        workers...number of pool processes
+        started...Queue the pool initializer puts each worker pid on
+        poll......seconds between worker checks
+    """
+    pids = set()
+    pending = [pool.apply_async(func, (b,)) for b in batches]
+    done = 0
+    while pending:
+        pending[0].wait(poll)
+        for r in [r for r in pending if r.ready()]:
+            try:
+                done += r.get()
+            except Exception:
+                pool.terminate()
+                raise
+            report_progress(done, total)
+        pending = [r for r in pending if not r.ready()]
+        try:
+            while True:
+                pids.add(started.get_nowait())
+        except Empty:
+            pass
+        if pending and len(pids) > workers:
+            pool.terminate()
+            raise RuntimeError("A worker died and was replaced with %d batches unfinished" % len(pending))
+
+
+def term_path(model_dir, t):
+    """
+    File of the model of term t
+    """
+    return os.path.join(model_dir, "term.%d.pkl" % t)
+
+
+def model_key(clf, X, Y):
+    """
+    Key of term models of a classifier trained on a feature set and labels, so
+    models of different runs are kept apart. The features are hashed by
+    content, so features rebuilt with the same shape get new models.
+    Params:
+        clf...classifier
+        X.....csr or dense feature matrix
+        Y.....NxT csr matrix of true terms
+    """
+    h = hashlib.sha1(repr(sorted(clf.get_params().items())))
+    h.update(repr(X.shape))
+    arrays = [X.indptr, X.indices, X.data] if hasattr(X, 'indptr') else [X]
+    for a in arrays:
+        h.update(repr(a.dtype))
+        h.update(np.ascontiguousarray(a))
+    h.update(Y.indptr.tobytes())
+    h.update(Y.indices.tobytes())
+    return h.hexdigest()[:16]
+
+
+def load_term(model_dir, t):
+    """
+    Load the saved model of term t
+    """
+    with open(term_path(model_dir, t), 'rb') as f:
+        return pickle.load(f)
+
+
+def save_term(model_dir, t, model):
+    """
+    Save the model of term t, only renamed into place once it is complete
+    """
+    filename = term_path(model_dir, t)
+    with open(filename + ".tmp", 'wb') as f:
+        pickle.dump(model, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + ".tmp", filename)
+
+
+class TermModels(object):
+    """
+    One binary model per GO term, a drop in for OneVsRestClassifier. The
+    features are memory mapped once and shared by a pool sized to the
+    available cpus, terms are batched by positive count so batches cost about
+    the same, and every term model is saved as soon as it is trained, so an
+    interrupted run resumes with only the missing terms.
+    """
+    def __init__(self, clf, model_dir, workers=0):
+        self.clf = clf
+        self.model_dir = model_dir
+        self.workers = workers
+        self.path = None
+
+    def fit(self, X, Y):
+        Y = csr_matrix(Y)
+        # models of a different classifier, feature set or row subset are kept apart
+        self.path = os.path.join(self.model_dir, model_key(self.clf, X, Y))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.nterms = Y.shape[1]
+
+        todo = [t for t in range(self.nterms) if not os.path.exists(term_path(self.path, t))]
+        print "Training %d of %d term models in %s" % (len(todo), self.nterms, self.path)
+        if not todo:
+            return self
+
+        cpus = num_workers()
+        workers = min(len(todo), num_workers(self.workers))
+        threads = max(1, cpus // workers)
+        pos = Y.getnnz(0)[todo]
+        batches = term_batches(todo, pos, workers * 4)
+
+        feature_path = tempfile.mkdtemp(prefix="go_features.")
+        try:
+            fs.save_features(feature_path, X)
+            started = Queue()
+            pool = Pool(processes=workers, initializer=init_term_worker,
+                        initargs=(feature_path, Y.tocsc(), self.clf, self.path, threads, started))
+            run_batches(pool, fit_terms, batches, len(todo), workers, started)
+            pool.close()
+            pool.join()
+        finally:
+            shutil.rmtree(feature_path)
+        return self
+
+    def predict_proba(self, X):
+        probs = np.zeros((X.shape[0], self.nterms))
+        for t in range(self.nterms):
+            model = load_term(self.path, t)
+            if isinstance(model, dict):
+                probs[:, t] = model['constant']
+            else:
+                probs[:, t] = model.predict_proba(X)[:, 1]
+        return probs
+
+
+class SharedBinTermModels(object):
+    """
+    One boosted binary model per GO term, all trained on a single binned
+    LightGBM dataset or XGBoost DMatrix. The features are converted and
+    quantized once per fit and only the labels are swapped between terms, so
+    adding terms only adds tree growth. Term models are saved as they finish,
+    like TermModels, so an interrupted run resumes.
+    """
+    def __init__(self, clf, m, model_dir):
+        self.clf = clf
+        self.m = m
+        self.model_dir = model_dir
+        self.path = None
+
+    def fit(self, X, Y):
+        Y = csr_matrix(Y)
+        self.path = os.path.join(self.model_dir, "shared." + model_key(self.clf, X, Y))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.nterms = Y.shape[1]
+
+        todo = [t for t in range(self.nterms) if not os.path.exists(term_path(self.path, t))]
+        print "Training %d of %d term models on shared bins in %s" % (len(todo), self.nterms, self.path)
+        if not todo:
+            return self
+
+        Y = Y.tocsc()
+        # LightGBM crashes on integer count matrices
+        X = X.astype(np.float32, copy=False)
+        if self.m == 'LightGBM':
+            params, rounds = stream_train.lightgbm_params(self.clf, 2)
+            data = lgb.Dataset(X, label=np.zeros(X.shape[0]), params=params).construct()
+        else:
+            params, rounds = stream_train.xgboost_params(self.clf, 2, X.shape[1])
+            data = xgb.DMatrix(X)
+
+        for done, t in enumerate(todo):
+            y = Y[:, t].toarray().ravel()
+            if y.min() == y.max():
+                model = {'constant': float(y[0])}
+            else:
+                data.set_label(y)
+                if self.m == 'LightGBM':
+                    model = lgb.train(params, data, rounds)
+                else:
+                    model = xgb.train(params, data, rounds)
+            save_term(self.path, t, model)
+            report_progress(done + 1, len(todo))
+        return self
+
+    def predict_proba(self, X):
+        probs = np.zeros((X.shape[0], self.nterms))
+        X = X.astype(np.float32, copy=False)
+        data = X if self.m == 'LightGBM' else xgb.DMatrix(X)
+        for t in range(self.nterms):
+            model = load_term(self.path, t)
+            if isinstance(model, dict):
+                probs[:, t] = model['constant']
+            else:
+                probs[:, t] = model.predict(data)
+        return probs
 
 
 def cross_validation_accuracy(clf, X, labels, skf, m):
@@ -36,20 +320,22 @@ def cross_validation_accuracy(clf, X, labels, skf, m):
     scores = []
     train_scores = []
     i = 0
+    if not os.path.exists(clf.model_dir):
+        os.makedirs(clf.model_dir)
     for train_index, test_index in skf:
         print "Classifying on fold:", i
         i+=1
         X_train, X_test = X[train_index], X[test_index]
         y_train, y_test = labels[train_index], labels[test_index]
-        if m == 'RandomForest' or m == 'Regression' or m == 'LightGBM':
-            clf.fit(X_train, y_train)
-        else:
-            clf.fit(X_train, y_train,
-                    eval_set=[(X_train, y_train), (X_test, y_test)],
-                    early_stopping_rounds=2,
-                    verbose=False,)
-        probs = clf.predict_proba(X_test)
-        train_probs = clf.predict_proba(X_train)
+        # fold models are only needed for scoring the fold
+        fold_clf = copy.copy(clf)
+        fold_clf.model_dir = tempfile.mkdtemp(prefix="cv_fold.", dir=clf.model_dir)
+        try:
+            fold_clf.fit(X_train, y_train)
+            probs = fold_clf.predict_proba(X_test)
+            train_probs = fold_clf.predict_proba(X_train)
+        finally:
+            shutil.rmtree(fold_clf.model_dir)
         train_score = fmax(train_probs,y_train)
         scores.append(fmax(probs,y_test))
         train_scores.append(train_score)
@@ -57,12 +343,13 @@ def cross_validation_accuracy(clf, X, labels, skf, m):
     return np.mean(scores), np.mean(train_scores)
 
 
-def test_train_split(clf, split):
+def test_train_split(clf, split, m):
     """
     Compute the accuracy of a train/test split
     Params:
         clf......A classifier.
         split....indices
+        m........The model name
     Returns:
         The testing accuracy and the confusion
         matrix.
@@ -77,11 +364,12 @@ def test_train_split(clf, split):
 
     score = fmax(probs, y_test)
     train_score = fmax(train_probs, y_train)
+    save_pr_curve(probs, y_test, m)
 
     return score, train_score, clf
 
 
-def classify_all(labels, features, clfs, folds, model_names, cv, mem):
+def classify_all(labels, features, clfs, folds, model_names, cv, mem, workers=0, shared_bins=False):
     """
     Compute the average testing accuracy over k folds of cross-validation.
     Params:
@@ -92,6 +380,8 @@ def classify_all(labels, features, clfs, folds, model_names, cv, mem):
         model_names..Readable names of each classifier
         cv...........Whether to use cross validation
         mem..........Whether to store memory usage
+        workers......Term models trained at once, 0 for all available cpus
+        shared_bins..Train the boosters' term models on one shared binned dataset
     """
 
     tts_split = train_test_split(
@@ -108,7 +398,10 @@ def classify_all(labels, features, clfs, folds, model_names, cv, mem):
         print "Classiying with", mn
         logging.info("Classifying with %s", mn)
 
-        clf = OneVsRestClassifier(clfs[x], n_jobs=100)
+        if shared_bins and (mn == 'LightGBM' or mn == 'XGBoost'):
+            clf = SharedBinTermModels(clfs[x], mn, "results/go_models/" + mn)
+        else:
+            clf = TermModels(clfs[x], "results/go_models/" + mn, workers)
 
         if cv:
             cv_score, cv_train_score = cross_validation_accuracy(clf, features, labels, skf, mn)
@@ -120,10 +413,10 @@ def classify_all(labels, features, clfs, folds, model_names, cv, mem):
             cv_score = -1
             cv_train_score = -1
 
-        args = (clf, tts_split)
+        args = (clf, tts_split, mn)
         if mem:
             mem_usage, retval = memory_usage((test_train_split, args), interval=0.5, retval=True)
-            tts_score, tts_train_score, clf, t5 = retval
+            tts_score, tts_train_score, clf = retval
 
             avg_mem = np.mean(mem_usage)
             max_mem = max(mem_usage)
@@ -149,34 +442,33 @@ def classify_all(labels, features, clfs, folds, model_names, cv, mem):
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename)
-    return csr_matrix((loader['data'], loader['indices'], loader['indptr']),
-                         shape=loader['shape'], dtype="float32")
+    return fs.load_csr(filename)[0].astype(np.float32)
 
 
 def load_data(size, aa1, aa2, aa3, aa4):
     path = "data/" + size + '/'
     files = []
     if aa1:
-        features = load_sparse_csr(path + "feature_matrix.aa1.csr.npz")
+        features = load_sparse_csr(path + "feature_matrix.aa1.csr")
         files.append(features)
     if aa2:
-        features = load_sparse_csr(path + "feature_matrix.aa2.csr.npz")
+        features = load_sparse_csr(path + "feature_matrix.aa2.csr")
         files.append(features)
     if aa3:
-        features = load_sparse_csr(path + "feature_matrix.aa3.csr.npz")
+        features = load_sparse_csr(path + "feature_matrix.aa3.csr")
         files.append(features)
     if aa4:
-        features = load_sparse_csr(path + "feature_matrix.aa4.csr.npz")
+        features = load_sparse_csr(path + "feature_matrix.aa4.csr")
         files.append(features)
 
-    labels = load_sparse_csr("data/cafa_labels.npz")
+    labels = load_sparse_csr("data/cafa_labels")
 
     if not files:
         print "No dataset provided"
         exit(0)
 
-    features = hstack(files, format='csr')
+    # A single matrix is used as is instead of being copied by hstack
+    features = files[0] if len(files) == 1 else hstack(files, format='csr')
     return features, labels
 
 
@@ -196,6 +488,8 @@ def get_parser():
     parser.add_argument("--regr", default=False, action='store_true', help="build regression model")
     parser.add_argument("--thread",  default=-1, type=int, help="specify number of threads to to run with")
     parser.add_argument("--prune", default=0, type=int, help="remove features with apperance below prune")
+    parser.add_argument("--shared_bins", default=False, action='store_true', help="train lgbm/xgb term models on one shared binned dataset")
+    parser.add_argument("--workers", default=0, type=int, help="term models to train at once, defaults to available cpus")
     return parser
 
 
@@ -288,44 +582,97 @@ def main():
     features = features[nonz_rows]
     labels = labels[nonz_rows]
 
-    results = classify_all(labels, features, clfs, folds, model_names, args.cv, args.mem)
+    results = classify_all(labels, features, clfs, folds, model_names, args.cv, args.mem, args.workers, args.shared_bins)
     for t in results.Time:
         print t,
     print
     print results.to_string()
 
 
-def fmax(preds,true):
-    print "Maximizing f score with prob threshhold"
-    max = 0
-    for i in np.arange(0.1,1,0.1):
-        pr, rc = precision_recall(preds, true, i)
-        f = (2 * pr * rc)/(pr + rc)
-        if f > max:
-            max = f
-
-    return max
-
-
-def precision_recall(preds, true, thresh):
-    m = 0
-    tps = []
-    rcs = []
-    for x in range(true.shape[0]):
-        t = true[x].todense()
-        pred = preds[x] > thresh
-        if pred.any():
-            tp = np.sum(np.logical_and(pred, t == 1))
-            tps.append(tp/np.sum(pred))
-            rcs.append(tp/np.sum(t))
-            m += 1
-        else:
-            rcs.append(0)
+def pr_curve(preds, true, thresholds=None, block_rows=1000):
+    """
+    Protein centric precision and recall at every threshold, a block of proteins
+    at a time. Each score is binned by the number of thresholds below it, so a
+    histogram of the bins of a protein's predictions, and of its true terms,
+    read from the top down gives its prediction and true positive counts at
+    every threshold without sorting the scores.
+    Params:
+        preds........NxT term probabilities
+        true.........NxT binary csr matrix of true terms
+        thresholds...thresholds to evaluate, predictions above one count
+        block_rows...proteins scored at a time
+    Returns:
+        thresholds, precision averaged over proteins with a prediction and recall
+        averaged over all proteins
+    """
+    if thresholds is None:
+        thresholds = np.arange(0.01, 1, 0.01)
+    thresholds = np.asarray(thresholds, dtype=float)
+    order = np.argsort(thresholds, kind='mergesort')
+    sorted_thresholds = thresholds[order]
+    nbins = len(thresholds) + 1
+    true = csr_matrix(true)
+    true.eliminate_zeros()
+    n = preds.shape[0]
+
+    precision_sum = np.zeros(len(thresholds))
+    recall_sum = np.zeros(len(thresholds))
+    covered = np.zeros(len(thresholds))
+    for start in range(0, n, block_rows):
+        block = np.asarray(preds[start:start + block_rows], dtype=float)
+        b = block.shape[0]
+        bins = np.searchsorted(sorted_thresholds, block, side='left')
+        row_bins = np.arange(b)[:, None] * nbins + bins
+        t = true[start:start + b]
+        t_rows = np.repeat(np.arange(b), np.diff(t.indptr))
+        pred_hist = np.bincount(row_bins.ravel(), minlength=b * nbins).reshape(b, nbins)
+        hit_hist = np.bincount(row_bins[t_rows, t.indices], minlength=b * nbins).reshape(b, nbins)
+
+        # counts at threshold k are of the entries in bins above k
+        npred = np.cumsum(pred_hist[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        tp = np.cumsum(hit_hist[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        has = npred > 0
+        precision_sum += (tp / np.maximum(npred, 1).astype(float)).sum(axis=0)
+        covered += has.sum(axis=0)
+        recall_sum += (tp / np.maximum(np.diff(t.indptr), 1).astype(float)[:, None]).sum(axis=0)
+
+    pr = np.zeros(len(thresholds))
+    rc = np.zeros(len(thresholds))
+    pr[order] = precision_sum / np.maximum(covered, 1)
+    rc[order] = recall_sum / float(max(n, 1))
+    return thresholds, pr, rc
+
+
+def fmax(preds, true, thresholds=None):
+    """
+    Maximum protein centric f score over prediction thresholds
+    Params:
+        preds........NxT term probabilities
+        true.........NxT binary csr matrix of true terms
+        thresholds...thresholds to evaluate, 0.01 to 0.99 by default
+    Returns:
+        Fmax
+    """
+    thresholds, pr, rc = pr_curve(preds, true, thresholds)
+    f = 2 * pr * rc / np.maximum(pr + rc, 1e-12)
+    return f.max()
 
-    pr = 1/float(m) * float(np.sum(tps))
-    rc = 1/float(len(true)) * float(np.sum(rcs))
 
-    return pr, rc
+def save_pr_curve(preds, true, m):
+    """
+    Save the precision recall curve of a model
+    Params:
+        preds...NxT term probabilities
+        true....NxT binary csr matrix of true terms
+        m.......The model name
+    """
+    thresholds, pr, rc = pr_curve(preds, true)
+    f = 2 * pr * rc / np.maximum(pr + rc, 1e-12)
+    curve = pd.DataFrame({'threshold': thresholds, 'precision': pr, 'recall': rc, 'f': f})
+    if not os.path.exists('results/pr_curves'):
+        os.makedirs('results/pr_curves')
+    curve.to_csv('results/pr_curves/' + m + strftime("%m-%d_%H_%M", gmtime()) + '.csv', index=0,
+                 columns=['threshold', 'precision', 'recall', 'f'])
 
 
 if __name__ == '__main__':
@@ -13,6 +13,7 @@ import resnet
 import threading
 import argparse
 import densenet
+import feature_store as fs
 
 
 def nn_batch_generator(X_data, y_data, batch_size, csr_2d, m):
@@ -160,9 +161,7 @@ def classify(features, labels, use_batches, file, m, batch_size,
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename)
-    return csr_matrix((loader['data'], loader['indices'], loader['indptr']),
-                         shape=loader['shape']), loader['labels']
+    return fs.load_csr(filename)
 
 
 def load_data(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
@@ -170,35 +169,36 @@ def load_data(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
 
     files = []
     if dna1:
-        features, labels = load_sparse_csr(path + "feature_matrix.1.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.1.csr")
         files.append(features)
     if dna3:
-        features, labels = load_sparse_csr(path + "feature_matrix.3.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.3.csr")
         files.append(features)
     if dna5:
-        features, labels = load_sparse_csr(path + "feature_matrix.5.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.5.csr")
         files.append(features)
     if dna10:
-        features, labels = load_sparse_csr(path + "feature_matrix.10.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.10.csr")
         files.append(features)
     if aa1:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa1.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa1.csr")
         files.append(features)
     if aa2:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa2.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa2.csr")
         files.append(features)
     if aa3:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa3.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa3.csr")
         files.append(features)
     if aa4:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa4.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa4.csr")
         files.append(features)
 
     if not files:
         print "No dataset provided"
         exit(0)
 
-    features = hstack(files, format='csr')
+    # A single matrix is used as is so it stays a memory mapped view
+    features = files[0] if len(files) == 1 else hstack(files, format='csr')
 
     return features, labels
 
@@ -1,8 +1,9 @@
 from os import listdir
 from os.path import isfile, join
 import numpy as np
-from scipy.sparse import csr_matrix, vstack
+from scipy.sparse import csr_matrix
 import os, sys
+from feature_store import CsrWriter
 
 
 def load_sparse_csr(filename):
@@ -11,34 +12,35 @@ def load_sparse_csr(filename):
                          shape = loader['shape']), loader['labels'], loader['vocab']
 
 
-def save_sparse_csr(filename,array, labels, vocab):
+def chunk_number(filename):
     """ 
-    Save csr matrix in loadable format
-    Params:
-        filename...save path
-        array......csr matrix
-        labels.....ordered true labels
-        vocab......maps kmer to feature vector index
+    Chunk index of a chunk.N.csr.npz file written by an older preprocess.read_chunks
     """
-    np.savez(filename,data = array.data ,indices=array.indices,
-             indptr =array.indptr, shape=array.shape, labels=labels, vocab=vocab)
+    return int(filename.split("chunk.")[-1].split(".")[0])
 
 
 def main(path = "data/feature_matrix.lg.10"):
+    """ 
+    Stream a directory of legacy chunk files into one on-disk feature matrix,
+    loading a single chunk at a time. preprocess.read_chunks now writes the
+    combined matrix directly.
+    Params:
+        path...directory of chunk.N.csr.npz files
+    """
+    files = sorted([join(path, f) for f in listdir(path) if isfile(join(path, f))], key=chunk_number)
 
-    files = [join(path, f) for f in listdir(path) if isfile(join(path, f))]
-
-    csrs = []
-    labels = []
+    writer = None
     for f in files:
         csr, l, vocab = load_sparse_csr(f)
-        csrs.append(csr)
-        labels.extend(l)
-
-    print "Stacking csrs"
-    csr_matrix = vstack(csrs)
-
-    save_sparse_csr(path + ".csr", csr_matrix, labels, vocab)
+        if writer is None:
+            vocab = vocab.tolist()
+            if not isinstance(vocab, dict) or 'ncols' not in vocab:
+                vocab = None
+            writer = CsrWriter(path + ".csr", csr.shape[1], vocab=vocab)
+        print "Appending", f
+        writer.append(csr, l)
+
+    writer.close()
 
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ from scipy.sparse import csr_matrix, hstack
 import numpy as np
 import sys
 from sklearn.feature_extraction.text import TfidfTransformer
+import feature_store as fs
 
 
 def convert_labels(labels):
@@ -26,23 +27,21 @@ def save_sparse_csr(filename,array, labels, vocab):
         filename...save path
         array......csr matrix
         labels.....ordered true labels
-        vocab......maps kmer to feature vector index
+        vocab......describes the kmers behind each block of feature vector indexes
     """
-    np.savez(filename,data = array.data ,indices=array.indices,
-             indptr =array.indptr, shape=array.shape, labels=labels, vocab=vocab)
+    fs.save_csr(filename, array, labels, vocab)
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename)
-    return csr_matrix((loader['data'], loader['indices'], loader['indptr']),
-                         shape=loader['shape']), loader['labels'], loader['vocab']
+    features, labels = fs.load_csr(filename)
+    return features, labels, fs.read_header(filename)['vocab']
 
 
 def main(size="sm"):
     path = "data/" + size
-    features, labels, vocab = load_sparse_csr(path + "/feature_matrix.3.csr.npz")
+    features, labels, vocab = load_sparse_csr(path + "/feature_matrix.3.csr")
     print features.shape
-    vocab = dict(vocab.tolist())
+    vocab['offset'] = 0
 
     tfer = TfidfTransformer()
     tfer.fit(features[:,:32],labels)
@@ -51,9 +50,9 @@ def main(size="sm"):
 
     labels = convert_labels(labels)
 
-    features2, _, vocab2 = load_sparse_csr(path + "/feature_matrix.5.csr.npz")
+    features2, _, vocab2 = load_sparse_csr(path + "/feature_matrix.5.csr")
     print features2.shape
-    vocab2 = dict(vocab2.tolist())
+    vocab2['offset'] = features.shape[1]
     #features2 = features2[:,:-5]
 
     tfer.fit(features2)
@@ -61,12 +60,9 @@ def main(size="sm"):
 
     features = hstack([features, features2],format='csr')
 
-    for key, value in vocab2.iteritems():
-        vocab2[key] = value + features.shape[1]
-
-    features3, _, vocab3 = load_sparse_csr(path + "/feature_matrix.10.csr.npz")
+    features3, _, vocab3 = load_sparse_csr(path + "/feature_matrix.10.csr")
     print features3.shape
-    vocab3 = dict(vocab3.tolist())
+    vocab3['offset'] = features.shape[1]
     #features3 = features3[:,:-5]
 
     tfer.fit(features3)
@@ -74,10 +70,7 @@ def main(size="sm"):
 
     features = hstack([features, features3],format='csr', dtype="Float32")
 
-    for key, value in vocab3.iteritems():
-        vocab3[key] = value + features.shape[1] + features2.shape[1]
-
-    vocab = dict(vocab.items() + vocab2.items() + vocab3.items())
+    vocab = [vocab, vocab2, vocab3]
 
     save_sparse_csr("data/" + size + "/feature_matrix.3.5.10.csr", features, labels, vocab)
 
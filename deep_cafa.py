@@ -15,9 +15,8 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder, OneHotEncoder
 from res50_nt import Res50NT
 from sklearn.metrics import f1_score
-import re
 import math
-import networkx as nx
+import go_index
 
 
 aa_chars = ' FSYCLIMVPTAHQNKDEWRGUXBZO'.lower()
@@ -112,39 +111,24 @@ def simple_model(classes=100):
 
 
 def construct_dag():
-    Gs = {'m': nx.DiGraph(), 'c': nx.DiGraph(), 'b': nx.DiGraph()}
-    print "Loading GO data"
-    file = "data/go-basic.obo"
-    with open (file, 'r') as f:
-        terms = f.read().split("[Term]")
-
-    alt_dict = {}
-
-    for term in terms:
-        obs = re.search("is_obsolete: true", term)
-        if not obs:
-            id = re.match("id: GO:\d+", term.strip()).group(0)[4:]
-            alts = re.findall("alt_id: GO:\d+", term)
-            category = re.search("namespace: \w", term).group(0)[-1]
-            if alts:
-                for alt in alts:
-                    alt_dict[alt[8:]] = id
-
-            Gs[category].add_node(id)
-            is_as = re.findall("is_a: GO:\d+", term)
-            Gs[category].add_edges_from([(x[6:], id) for x in is_as if x])
-            part_ofs = re.findall("part_of GO:\d+", term)
-            Gs[category].add_edges_from([(x[8:], id) for x in part_ofs if x])
-
-    for G in Gs.values():
-        print G.number_of_edges()
-        print G.number_of_nodes()
-        print [n for n,d in G.in_degree().items() if d==0]
-
-    return Gs, alt_dict
-
-
-def proc_cafa():
+    """
+    GO ontology as an integer id index with its ancestor closure, parsed from
+    data/go-basic.obo once and loaded from data/go_index.npz after that
+    Returns:
+        go_index.GoIndex
+    """
+    return go_index.load_go_index()
+
+
+def proc_cafa(propagate=False):
+    """
+    Read the CAFA sequences and their GO terms
+    Params:
+        propagate...also label every ancestor of each term, the true path rule
+    Returns:
+        Dataframe of sequences, csr matrix of labels and the term vocab
+    """
+    go = go_index.load_go_index() if propagate else None
     seqs_file = "data/uniprot_sprot_exp.fasta"
     term_file = "data/uniprot_sprot_exp.txt"
     seq_dict = {}
@@ -157,7 +141,6 @@ def proc_cafa():
             seq_dict[seq[0]] = seq[1]
 
     X = []
-    y = []
     seq_names = []
     term_dict = defaultdict(list)
     term_vocab = {}
@@ -173,14 +156,15 @@ def proc_cafa():
             if term[1] not in term_vocab:
                 term_vocab[term[1]] = len(term_vocab)
 
+    rows = []
+    cols = []
     for k,v in seq_dict.items():
-        X.append(v)
-        label_vec = [0] * len(term_vocab)
         for term in term_dict[k]:
-            label_vec[term_vocab[term]] = 1
-        y.append(label_vec)
+            rows.append(len(X))
+            cols.append(term_vocab[term])
+        X.append(v)
 
-    y = csr_matrix(y)
+    y = go_index.label_matrix(rows, cols, len(X), term_vocab, go)
     X = np.array(X)
 
     cafa_df = pd.DataFrame({"aa":X})
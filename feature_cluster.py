@@ -4,12 +4,12 @@ from scipy.sparse import csr_matrix, hstack
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import normalize
+import feature_store as fs
 
 
 def load_sparse_csr(filename):
-    loader = np.load(filename)
-    return csr_matrix((loader['data'], loader['indices'], loader['indptr']),
-                         shape=loader['shape'], dtype="float32"), loader['labels']
+    matrix, labels = fs.load_csr(filename)
+    return matrix.astype("float32"), labels
 
 
 def unique_class_names(names):
@@ -50,28 +50,28 @@ def load_data(size, dna1, dna3, dna5, dna10, aa1, aa2, aa3, aa4):
 
     files = []
     if dna1:
-        features, labels = load_sparse_csr(path + "feature_matrix.1.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.1.csr")
         files.append(features)
     if dna3:
-        features, labels = load_sparse_csr(path + "feature_matrix.3.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.3.csr")
         files.append(features)
     if dna5:
-        features, labels = load_sparse_csr(path + "feature_matrix.5.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.5.csr")
         files.append(features)
     if dna10:
-        features, labels = load_sparse_csr(path + "feature_matrix.10.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.10.csr")
         files.append(features)
     if aa1:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa1.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa1.csr")
         files.append(features)
     if aa2:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa2.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa2.csr")
         files.append(features)
     if aa3:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa3.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa3.csr")
         files.append(features)
     if aa4:
-        features, labels = load_sparse_csr(path + "feature_matrix.aa4.csr.npz")
+        features, labels = load_sparse_csr(path + "feature_matrix.aa4.csr")
         files.append(features)
 
     if not files:
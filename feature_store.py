@@ -0,0 +1,547 @@
+import numpy as np
+import json
+import os
+from os.path import join
+from scipy.sparse import csr_matrix, vstack, issparse
+
+
+# Every array header is padded to this many bytes so it can be rewritten in place
+# once the final length is known
+HEADER_BYTES = 128
+# Stores up to this wide count column document frequency in a dense array, wider
+# ones, like unhashed long k-mers, only keep counts of the columns that occur
+DENSE_DF_COLS = 2 ** 24
+
+
+def npy_header(dtype, length):
+    """
+    Fixed size .npy (version 1.0) header for a 1d array
+    Params:
+        dtype....array dtype
+        length...number of elements
+    Returns:
+        HEADER_BYTES long header string
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), length)
+    header_len = HEADER_BYTES - 10
+    header = header.ljust(header_len - 1) + '\n'
+    return np.lib.format.MAGIC_PREFIX + '\x01\x00' + np.array(header_len, dtype='<u2').tobytes() + header
+
+
+def merge_counts(cols, counts, indices):
+    """
+    Add the occurrences of every column in indices to sparse column counts
+    Params:
+        cols......sorted columns counted so far
+        counts....count of each of cols
+        indices...column indices to add
+    Returns:
+        Sorted columns and their counts
+    """
+    new_cols, new_counts = np.unique(indices, return_counts=True)
+    cols, inverse = np.unique(np.concatenate([cols, new_cols]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts]), minlength=len(cols))
+    return cols, counts.astype(np.int64)
+
+
+def index_dtype(n):
+    """
+    Smallest index dtype that holds n, scipy keeps memory mapped indices and
+    indptr without a copy only if both have the dtype it picks from the shape
+    and nnz
+    Params:
+        n...largest of the number of rows, columns and stored entries
+    """
+    return np.int32 if n < 2 ** 31 else np.int64
+
+
+class CsrWriter(object):
+    """
+    Append row blocks of a csr matrix to growing .npy files on disk, so the whole
+    matrix never has to be in memory. Writes to a directory holding data.npy,
+    indices.npy, indptr.npy, labels.txt, df.npy with the number of rows storing
+    each column and a header.json with shape and vocab. Stores wider than
+    DENSE_DF_COLS save df.npy only for the columns listed in df_cols.npy.
+    indices and indptr share one dtype, widened to int64 once the store
+    outgrows int32.
+    """
+    def __init__(self, path, ncols, data_dtype=np.uint16, vocab=None):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.ncols = ncols
+        self.vocab = vocab
+        self.data_dtype = np.dtype(data_dtype)
+        self.index_dtype = np.dtype(index_dtype(ncols))
+        self.nrows = 0
+        self.nnz = 0
+        self.df = np.zeros(ncols, dtype=np.int64) if ncols <= DENSE_DF_COLS else None
+        self.df_cols = np.zeros(0, dtype=np.int64)
+        self.df_counts = np.zeros(0, dtype=np.int64)
+        self.data = open(join(path, "data.npy"), 'wb')
+        self.indices = open(join(path, "indices.npy"), 'wb')
+        self.indptr = open(join(path, "indptr.npy"), 'wb')
+        self.labels = open(join(path, "labels.txt"), 'w')
+        self.data.write(npy_header(self.data_dtype, 0))
+        self.indices.write(npy_header(self.index_dtype, 0))
+        self.indptr.write(npy_header(self.index_dtype, 1))
+        self.indptr.write(np.zeros(1, dtype=self.index_dtype).tobytes())
+
+    def widen(self, batch=2 ** 24):
+        """
+        Rewrite the indices and indptr written so far as int64
+        Params:
+            batch...elements converted at a time
+        """
+        for name, length in [("indices", self.nnz), ("indptr", self.nrows + 1)]:
+            getattr(self, name).close()
+            filename = join(self.path, name + ".npy")
+            with open(filename + ".tmp", 'wb') as f:
+                f.write(npy_header(np.int64, length))
+                if length:
+                    old = np.memmap(filename, dtype=self.index_dtype, mode='r',
+                                    offset=HEADER_BYTES, shape=(length,))
+                    for start in range(0, length, batch):
+                        f.write(old[start:start + batch].astype(np.int64).tobytes())
+                    del old
+            os.rename(filename + ".tmp", filename)
+            f = open(filename, 'r+b')
+            f.seek(0, 2)
+            setattr(self, name, f)
+        self.index_dtype = np.dtype(np.int64)
+
+    def append(self, block, labels=None):
+        """
+        Write the rows of a csr block after the rows already written
+        Params:
+            block....csr matrix with ncols columns
+            labels...true label of each row
+        """
+        block = csr_matrix(block)
+        if block.shape[1] != self.ncols:
+            raise ValueError("Block has %d columns, store has %d" % (block.shape[1], self.ncols))
+        data = block.data
+        if self.data_dtype.kind in 'ui' and len(data):
+            info = np.iinfo(self.data_dtype)
+            if data.max() > info.max or data.min() < info.min:
+                print "Saturating %d values outside [%d, %d]" % (
+                    np.sum((data > info.max) | (data < info.min)), info.min, info.max)
+                data = np.clip(data, info.min, info.max)
+        if max(self.nrows + block.shape[0], self.nnz + block.nnz) >= 2 ** 31 and self.index_dtype != np.int64:
+            self.widen()
+        self.data.write(data.astype(self.data_dtype).tobytes())
+        self.indices.write(block.indices.astype(self.index_dtype).tobytes())
+        self.indptr.write((block.indptr[1:].astype(np.int64) + self.nnz).astype(self.index_dtype).tobytes())
+        if self.df is not None:
+            self.df += np.bincount(block.indices, minlength=self.ncols)
+        else:
+            self.df_cols, self.df_counts = merge_counts(self.df_cols, self.df_counts, block.indices)
+        if labels is not None:
+            for label in labels:
+                self.labels.write(str(label) + '\n')
+        self.nrows += block.shape[0]
+        self.nnz += block.nnz
+
+    def close(self):
+        """
+        Rewrite the array headers with their final lengths and write header.json
+        """
+        for f, dtype, length in [(self.data, self.data_dtype, self.nnz),
+                                 (self.indices, self.index_dtype, self.nnz),
+                                 (self.indptr, self.index_dtype, self.nrows + 1)]:
+            f.seek(0)
+            f.write(npy_header(dtype, length))
+            f.close()
+        self.labels.close()
+        if self.df is not None:
+            np.save(join(self.path, "df.npy"), self.df)
+        else:
+            np.save(join(self.path, "df_cols.npy"), self.df_cols)
+            np.save(join(self.path, "df.npy"), self.df_counts)
+        with open(join(self.path, "header.json"), 'w') as f:
+            json.dump({'shape': [self.nrows, self.ncols], 'nnz': self.nnz,
+                       'vocab': self.vocab}, f)
+
+
+def save_csr(path, matrix, labels=None, vocab=None):
+    """
+    Save a csr matrix as a feature store directory
+    Params:
+        path.....store directory
+        matrix...csr matrix
+        labels...ordered true labels
+        vocab....describes the kmer behind each column, must be json serializable
+    """
+    matrix = csr_matrix(matrix)
+    writer = CsrWriter(path, matrix.shape[1], matrix.dtype, vocab)
+    writer.append(matrix, labels)
+    writer.close()
+
+
+def read_header(path):
+    """
+    Read the json header of a feature store
+    Params:
+        path...store directory
+    Returns:
+        Dictionary with shape, nnz and vocab
+    """
+    with open(join(path, "header.json"), 'r') as f:
+        return json.load(f)
+
+
+def load_labels(path):
+    """
+    Read the labels of a feature store
+    Params:
+        path...store directory
+    Returns:
+        Array of label strings, empty if the store has no labels
+    """
+    with open(join(path, "labels.txt"), 'r') as f:
+        return np.array(f.read().splitlines())
+
+
+def content_stamp(path):
+    """
+    Name, size and modification time of every file of a feature store, or of
+    the older path + ".npz" file, so caches built from it can tell when it was
+    rewritten
+    Params:
+        path...store directory, or any other directory of arrays
+    Returns:
+        json serializable list
+    """
+    if os.path.isdir(path):
+        names = [join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        names = [path + ".npz"]
+    stamp = []
+    for name in names:
+        stat = os.stat(name)
+        stamp.append([os.path.basename(name), stat.st_size, stat.st_mtime])
+    return stamp
+
+
+def load_df(path, batch_rows=100000):
+    """
+    Number of rows storing each column of a feature store, counted while it
+    was written, or counted a block of rows at a time for older stores
+    Params:
+        path.........store directory
+        batch_rows...rows counted at a time when there is no df.npy
+    Returns:
+        Sorted columns stored by at least one row and the number of rows
+        storing each of them
+    """
+    if os.path.exists(join(path, "df_cols.npy")):
+        return np.load(join(path, "df_cols.npy")), np.load(join(path, "df.npy"))
+    if os.path.exists(join(path, "df.npy")):
+        df = np.load(join(path, "df.npy"))
+        cols = np.nonzero(df)[0]
+        return cols, df[cols]
+    matrix, labels = load_csr(path)
+    cols = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    for start in range(0, matrix.shape[0], batch_rows):
+        indices = matrix.indices[matrix.indptr[start]:matrix.indptr[min(start + batch_rows, matrix.shape[0])]]
+        cols, counts = merge_counts(cols, counts, indices)
+    return cols, counts
+
+
+def prune_store(src, dst, min_df, batch_rows=100000):
+    """
+    Write a copy of a feature store without the columns stored by at most
+    min_df rows, streaming the memory mapped source a block of rows at a time.
+    The original index of every kept column is saved to columns.npy.
+    Params:
+        src..........source store directory
+        dst..........pruned store directory
+        min_df.......columns need more than this many rows to be kept
+        batch_rows...rows read at a time
+    Returns:
+        Original indices of the kept columns
+    """
+    matrix, labels = load_csr(src)
+    vocab = read_header(src)['vocab']
+    cols, counts = load_df(src)
+    keep = cols[counts > min_df]
+    if isinstance(vocab, dict):
+        vocab = dict(vocab, pruned=min_df, kept=len(keep))
+
+    writer = CsrWriter(dst, len(keep), matrix.dtype, vocab)
+    for start in range(0, matrix.shape[0], batch_rows):
+        block = matrix[start:start + batch_rows]
+        nrows = block.shape[0]
+        rows = np.repeat(np.arange(nrows), np.diff(block.indptr))
+        # new index of every kept column by search, the store can be too wide
+        # for a dense remapping array
+        cols = np.minimum(np.searchsorted(keep, block.indices), max(len(keep) - 1, 0))
+        mask = keep[cols] == block.indices if len(keep) else np.zeros(len(cols), dtype=bool)
+        indptr = np.zeros(nrows + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows[mask], minlength=nrows))
+        block = csr_matrix((block.data[mask], cols[mask], indptr), shape=(nrows, len(keep)))
+        writer.append(block, labels[start:start + batch_rows] if len(labels) else None)
+    writer.close()
+    np.save(join(dst, "columns.npy"), keep)
+    print "Pruned %d of %d columns stored by at most %d rows" % (matrix.shape[1] - len(keep), matrix.shape[1], min_df)
+    return keep
+
+
+def load_csr(path, mmap_mode='c'):
+    """
+    Open a feature store as a csr matrix whose data and indices are memory mapped,
+    so nothing is read until it is used. Falls back to the older np.savez format
+    when path is not a store directory but path + ".npz" exists.
+    Params:
+        path........store directory
+        mmap_mode...np.load mmap mode, the default copy-on-write mode lets callers
+                    modify the matrix in memory without touching the files
+    Returns:
+        csr matrix and the true labels
+    """
+    if not os.path.isdir(path):
+        loader = np.load(path + ".npz")
+        labels = loader['labels'] if 'labels' in loader.files else np.array([])
+        return csr_matrix((loader['data'], loader['indices'], loader['indptr']),
+                          shape=loader['shape']), labels
+    header = read_header(path)
+    data = np.load(join(path, "data.npy"), mmap_mode=mmap_mode)
+    indices = np.load(join(path, "indices.npy"), mmap_mode=mmap_mode)
+    indptr = np.load(join(path, "indptr.npy"), mmap_mode=mmap_mode)
+    matrix = csr_matrix((data, indices, indptr), shape=tuple(header['shape']), copy=False)
+    # scipy wraps the arrays in plain ndarray views, keep the memory maps themselves
+    # unless it had to convert them
+    if matrix.data.dtype == data.dtype:
+        matrix.data = data
+    if matrix.indices.dtype == indices.dtype and matrix.indptr.dtype == indptr.dtype:
+        matrix.indices = indices
+        matrix.indptr = indptr
+    elif mmap_mode is not None:
+        print "Warning: %s has %s indices and %s indptr, scipy copied them into memory" % (
+            path, indices.dtype, indptr.dtype)
+    return matrix, load_labels(path)
+
+
+def as_index(selection, n):
+    """
+    Convert a boolean mask or index list into an index array
+    Params:
+        selection...boolean mask of length n or integer indexes
+        n...........length of the selected axis
+    """
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        if len(selection) != n:
+            raise ValueError("Mask of length %d for axis of length %d" % (len(selection), n))
+        return np.nonzero(selection)[0]
+    return selection.astype(np.int64)
+
+
+def row_positions(indptr, rows):
+    """
+    Positions in data/indices of every entry of the given rows
+    Params:
+        indptr...csr row pointer
+        rows.....row indexes
+    Returns:
+        Entry positions and the number of entries of each row
+    """
+    starts = indptr[rows].astype(np.int64)
+    lens = indptr[rows + 1].astype(np.int64) - starts
+    firsts = np.cumsum(lens) - lens
+    pos = np.arange(lens.sum(), dtype=np.int64) + np.repeat(starts - firsts, lens)
+    return pos, lens
+
+
+def column_lookup(cols):
+    """
+    Search structure for the position of each selected column, so mapping
+    columns needs no array as wide as the store
+    Params:
+        cols...selected column indices, without repeats
+    Returns:
+        Sorted selected columns and the position of each in cols
+    """
+    order = np.argsort(cols, kind='mergesort')
+    return np.asarray(cols)[order], order
+
+
+def map_columns(lookup, indices):
+    """
+    Position of each column index among the selected columns
+    Params:
+        lookup....sorted columns and positions from column_lookup
+        indices...column indices
+    Returns:
+        int64 positions, -1 for columns that are not selected
+    """
+    sorted_cols, positions = lookup
+    if len(sorted_cols) == 0:
+        return -np.ones(len(indices), dtype=np.int64)
+    found = np.minimum(np.searchsorted(sorted_cols, indices), len(sorted_cols) - 1)
+    return np.where(sorted_cols[found] == indices, positions[found], -1).astype(np.int64)
+
+
+class LazyCsr(object):
+    """
+    Horizontally stacked csr blocks, usually memory mapped feature stores, with
+    pending row and column selections. Selections are only recorded, tocsr reads
+    the indices of the selected rows and the data of the selected entries only.
+    Column selections may reorder columns but not repeat them.
+    """
+    def __init__(self, blocks, rows=None, cols=None):
+        self.blocks = blocks
+        self.offsets = np.cumsum([0] + [b.shape[1] for b in blocks])
+        self.nrows = blocks[0].shape[0]
+        self.rows = rows
+        self.cols = cols
+
+    @property
+    def shape(self):
+        nrows = self.nrows if self.rows is None else len(self.rows)
+        ncols = self.offsets[-1] if self.cols is None else len(self.cols)
+        return nrows, ncols
+
+    def select_rows(self, rows):
+        """
+        Record a row selection relative to the current rows
+        Params:
+            rows...boolean mask or row indexes
+        """
+        rows = as_index(rows, self.shape[0])
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return LazyCsr(self.blocks, rows, self.cols)
+
+    def select_columns(self, cols):
+        """
+        Record a column selection relative to the current columns
+        Params:
+            cols...boolean mask or column indexes
+        """
+        cols = as_index(cols, self.shape[1])
+        if self.cols is not None:
+            cols = self.cols[cols]
+        return LazyCsr(self.blocks, self.rows, cols)
+
+    def hstack(self, block):
+        """
+        Append the columns of another csr block, which needs a row for every
+        selected row, or for every row of the unselected matrix
+        Params:
+            block...csr matrix
+        """
+        block = csr_matrix(block)
+        if self.rows is not None and block.shape[0] == len(self.rows):
+            # Spread rows aligned to the selection out to the unselected rows
+            if len(np.unique(self.rows)) != len(self.rows):
+                raise ValueError("Cannot align a block to repeated rows")
+            block = block.tocoo()
+            block = csr_matrix((block.data, (self.rows[block.row], block.col)),
+                               shape=(self.nrows, block.shape[1]))
+        elif block.shape[0] != self.nrows:
+            raise ValueError("Block has %d rows, matrix has %d selected of %d" % (
+                block.shape[0], self.shape[0], self.nrows))
+        cols = self.cols
+        if cols is not None:
+            cols = np.concatenate([cols, self.offsets[-1] + np.arange(block.shape[1])])
+        return LazyCsr(self.blocks + [block], self.rows, cols)
+
+    def _row_batches(self, batch_rows):
+        rows = np.arange(self.nrows) if self.rows is None else self.rows
+        for x in range(0, len(rows), batch_rows):
+            yield rows[x:x + batch_rows]
+
+    def getnnz(self, axis=0, batch_rows=100000):
+        """
+        Stored entries per selected column over the selected rows
+        Params:
+            axis.........only 0 (per column) is supported
+            batch_rows...rows read at a time
+        """
+        if axis != 0:
+            raise ValueError("Only column counts are supported")
+        if self.cols is not None:
+            # only the selected columns are counted
+            lookup = column_lookup(self.cols)
+            counts = np.zeros(len(self.cols), dtype=np.int64)
+            for block, offset in zip(self.blocks, self.offsets):
+                for rows in self._row_batches(batch_rows):
+                    pos, lens = row_positions(block.indptr, rows)
+                    cols = map_columns(lookup, block.indices[pos].astype(np.int64) + offset)
+                    counts += np.bincount(cols[cols >= 0], minlength=len(self.cols))
+            return counts
+        counts = []
+        for block in self.blocks:
+            if self.rows is None:
+                counts.append(np.bincount(block.indices, minlength=block.shape[1]))
+                continue
+            c = np.zeros(block.shape[1], dtype=np.int64)
+            for rows in self._row_batches(batch_rows):
+                pos, lens = row_positions(block.indptr, rows)
+                c += np.bincount(block.indices[pos], minlength=block.shape[1])
+            counts.append(c)
+        return np.concatenate(counts)
+
+    def tocsr(self, batch_rows=100000):
+        """
+        Read the selected rows and columns into an in memory csr matrix
+        Params:
+            batch_rows...rows read at a time
+        """
+        nrows, ncols = self.shape
+        lookup = None
+        if self.cols is not None:
+            lookup = column_lookup(self.cols)
+
+        parts = []
+        for rows in self._row_batches(batch_rows):
+            row_ids, col_ids, data = [], [], []
+            for block, offset in zip(self.blocks, self.offsets):
+                pos, lens = row_positions(block.indptr, rows)
+                cols = block.indices[pos].astype(np.int64) + offset
+                ids = np.repeat(np.arange(len(rows)), lens)
+                if lookup is not None:
+                    cols = map_columns(lookup, cols)
+                    keep = cols >= 0
+                    pos, cols, ids = pos[keep], cols[keep], ids[keep]
+                row_ids.append(ids)
+                col_ids.append(cols)
+                data.append(np.asarray(block.data[pos]))
+            data = np.concatenate(data)
+            parts.append(csr_matrix((data, (np.concatenate(row_ids), np.concatenate(col_ids))),
+                                    shape=(len(rows), ncols), dtype=data.dtype))
+        if not parts:
+            return csr_matrix((nrows, ncols))
+        return vstack(parts, format='csr')
+
+
+def save_features(path, features):
+    """
+    Save a sparse or dense feature matrix so other processes can memory map it
+    Params:
+        path.......store directory
+        features...csr matrix or dense array
+    """
+    if issparse(features):
+        save_csr(path, features)
+    else:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        np.save(join(path, "dense.npy"), features)
+
+
+def load_features(path, mmap_mode='c'):
+    """
+    Memory map a feature matrix written by save_features
+    Params:
+        path........store directory
+        mmap_mode...np.load mmap mode
+    Returns:
+        csr matrix or dense array
+    """
+    if os.path.exists(join(path, "dense.npy")):
+        return np.load(join(path, "dense.npy"), mmap_mode=mmap_mode)
+    return load_csr(path, mmap_mode)[0]
@@ -0,0 +1,250 @@
+import numpy as np
+import os
+from scipy.sparse import csr_matrix, coo_matrix, identity
+
+
+OBO_FILE = "data/go-basic.obo"
+INDEX_FILE = "data/go_index.npz"
+
+
+def parse_obo(filename=OBO_FILE):
+    """
+    Read the non obsolete terms of a GO obo file in one pass over its lines
+    Params:
+        filename...path of the obo file
+    Returns:
+        List of GO ids, namespace letter of each term ('m', 'c' or 'b'), dict of
+        alt_id to GO id and list of (child, parent) GO id edges from is_a and
+        part_of relations
+    """
+    ids = []
+    namespaces = []
+    alt_dict = {}
+    edges = []
+
+    def add(stanza):
+        if stanza and not stanza.get('obsolete'):
+            ids.append(stanza['id'])
+            namespaces.append(stanza['namespace'])
+            for alt in stanza['alts']:
+                alt_dict[alt] = stanza['id']
+            edges.extend((stanza['id'], p) for p in stanza['parents'])
+
+    stanza = None
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                add(stanza)
+                stanza = {'alts': [], 'parents': []} if line == "[Term]" else None
+            elif stanza is None or not line:
+                continue
+            elif line.startswith("id: "):
+                stanza['id'] = line[4:]
+            elif line.startswith("namespace: "):
+                stanza['namespace'] = line[11]
+            elif line.startswith("alt_id: "):
+                stanza['alts'].append(line[8:])
+            elif line.startswith("is_a: "):
+                stanza['parents'].append(line[6:].split()[0])
+            elif line.startswith("relationship: part_of "):
+                stanza['parents'].append(line[22:].split()[0])
+            elif line == "is_obsolete: true":
+                stanza['obsolete'] = True
+    add(stanza)
+    return ids, namespaces, alt_dict, edges
+
+
+def ancestor_closure(parents):
+    """
+    Every ancestor of every term, found by squaring the reachability matrix
+    until it stops growing, so the number of products grows with the log of the
+    depth of the ontology
+    Params:
+        parents...GxG csr matrix, row of a term holds its direct parents
+    Returns:
+        GxG boolean csr matrix, row of a term holds the term and all its ancestors
+    """
+    closure = (identity(parents.shape[0], dtype=bool, format='csr') + parents.astype(bool)).tocsr()
+    while True:
+        grown = closure.dot(closure).tocsr()
+        if grown.nnz == closure.nnz:
+            break
+        closure = grown
+    closure.sort_indices()
+    return closure
+
+
+class GoIndex(object):
+    """
+    GO ontology with terms numbered 0..G-1 in obo file order. Holds the direct
+    parent and ancestor closure matrices as csr, rows are children, so the
+    ancestors of term i are closure.indices[closure.indptr[i]:closure.indptr[i+1]].
+    """
+    def __init__(self, ids, namespaces, alt_ids, alt_targets, parents, closure):
+        self.ids = np.asarray(ids)
+        self.namespaces = np.asarray(namespaces)
+        self.alt_ids = np.asarray(alt_ids, dtype=self.ids.dtype)
+        self.alt_targets = np.asarray(alt_targets, dtype=np.int64)
+        self.parents = parents
+        self.closure = closure
+        self.index = dict((t, i) for i, t in enumerate(self.ids))
+        for alt, target in zip(self.alt_ids, self.alt_targets):
+            self.index.setdefault(alt, int(target))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def term_ids(self, terms):
+        """
+        Integer ids of GO terms, alt_ids map to their primary term
+        Params:
+            terms...iterable of GO id strings
+        Returns:
+            int array, -1 for terms not in the ontology
+        """
+        return np.array([self.index.get(t, -1) for t in terms], dtype=np.int64)
+
+    def ancestors(self, term):
+        """
+        GO ids of a term and all its ancestors
+        """
+        i = self.index[term]
+        return self.ids[self.closure.indices[self.closure.indptr[i]:self.closure.indptr[i + 1]]]
+
+    def propagate(self, labels):
+        """
+        Add every ancestor of each positive term, the true path rule, as one
+        sparse product
+        Params:
+            labels...NxG sparse matrix over the integer term ids
+        Returns:
+            NxG int8 csr matrix of 0/1 labels
+        """
+        labels = csr_matrix(labels, dtype=np.int32).dot(self.closure.astype(np.int32))
+        labels.data[:] = 1
+        return labels.astype(np.int8)
+
+    def save(self, filename, source=()):
+        """
+        Save the index as an npz file
+        Params:
+            filename...save path
+            source.....stamp of the obo file the index was built from
+        """
+        if not os.path.exists(os.path.dirname(filename) or "."):
+            os.makedirs(os.path.dirname(filename))
+        np.savez(filename, ids=self.ids, namespaces=self.namespaces,
+                 alt_ids=self.alt_ids, alt_targets=self.alt_targets,
+                 parents_indptr=self.parents.indptr, parents_indices=self.parents.indices,
+                 closure_indptr=self.closure.indptr, closure_indices=self.closure.indices,
+                 source=np.array(source, dtype=np.int64))
+
+
+def build_index(filename=OBO_FILE):
+    """
+    Parse an obo file into a GoIndex
+    Params:
+        filename...path of the obo file
+    """
+    print "Loading GO data", filename
+    ids, namespaces, alt_dict, edges = parse_obo(filename)
+    index = dict((t, i) for i, t in enumerate(ids))
+    # edges to obsolete or unknown terms are dropped
+    edges = [(index[c], index[p]) for c, p in edges if c in index and p in index]
+    rows = np.array([c for c, p in edges], dtype=np.int64)
+    cols = np.array([p for c, p in edges], dtype=np.int64)
+    parents = csr_matrix((np.ones(len(edges), dtype=bool), (rows, cols)), shape=(len(ids), len(ids)))
+    parents.sum_duplicates()
+    alt_ids = [a for a, t in alt_dict.items() if t in index]
+    alt_targets = [index[alt_dict[a]] for a in alt_ids]
+    return GoIndex(ids, namespaces, alt_ids, alt_targets, parents, ancestor_closure(parents))
+
+
+def source_stamp(filename):
+    """
+    Size and modification time of a file, to tell when a cache is stale
+    """
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def load_go_index(filename=OBO_FILE, cache=INDEX_FILE):
+    """
+    Load the GO index cached next to the obo file, parsing the obo file and
+    saving the index only when there is no cache or the obo file changed
+    Params:
+        filename...path of the obo file
+        cache......path of the cached index
+    Returns:
+        GoIndex
+    """
+    stamp = source_stamp(filename)
+    if os.path.exists(cache):
+        loader = np.load(cache)
+        if list(loader['source']) == stamp:
+            print "Using cached GO index", cache
+            n = len(loader['ids'])
+
+            def load_csr(name):
+                indices = loader[name + '_indices']
+                return csr_matrix((np.ones(len(indices), dtype=bool), indices, loader[name + '_indptr']),
+                                  shape=(n, n))
+
+            return GoIndex(loader['ids'], loader['namespaces'], loader['alt_ids'],
+                           loader['alt_targets'], load_csr('parents'), load_csr('closure'))
+    go = build_index(filename)
+    go.save(cache, stamp)
+    print "Saved GO index to", cache
+    return go
+
+
+def label_matrix(rows, cols, nrows, term_vocab, go=None):
+    """
+    0/1 label matrix built straight from (protein, term) index pairs. With a
+    GoIndex every positive term is propagated to all its ancestors by the true
+    path rule. Ancestors missing from term_vocab are added to it as new columns
+    after the existing ones, terms unknown to the ontology keep only their own
+    labels.
+    Params:
+        rows.........protein row of each pair
+        cols.........term_vocab column of each pair
+        nrows........number of proteins
+        term_vocab...maps GO term to label column, extended in place
+        go...........GoIndex to propagate with, or None
+    Returns:
+        NxT int8 csr matrix
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if go is None:
+        labels = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                            shape=(nrows, len(term_vocab))).tocsr()
+        labels.data[:] = 1
+        return labels
+
+    terms = [None] * len(term_vocab)
+    for t, x in term_vocab.items():
+        terms[x] = t
+    vocab_go = go.term_ids(terms)
+    known = vocab_go[cols] >= 0
+    labels = csr_matrix((np.ones(known.sum(), dtype=np.int8), (rows[known], vocab_go[cols[known]])),
+                        shape=(nrows, len(go)))
+    labels = go.propagate(labels)
+
+    # label column of every GO id, new columns for ancestors outside the vocab
+    go_col = np.full(len(go), -1, dtype=np.int64)
+    for x in np.where(vocab_go >= 0)[0][::-1]:
+        go_col[vocab_go[x]] = x
+    new = np.setdiff1d(np.unique(labels.indices), np.where(go_col >= 0)[0])
+    go_col[new] = len(term_vocab) + np.arange(len(new))
+    for g, x in zip(new, go_col[new]):
+        term_vocab[go.ids[g]] = int(x)
+
+    labels = labels.tocoo()
+    labels = coo_matrix((np.ones(labels.nnz + (~known).sum(), dtype=np.int8),
+                         (np.concatenate([labels.row, rows[~known]]),
+                          np.concatenate([go_col[labels.col], cols[~known]]))),
+                        shape=(nrows, len(term_vocab))).tocsr()
+    labels.data[:] = 1
+    return labels
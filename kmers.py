@@ -0,0 +1,423 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+ALPHABETS = {'dna': 'acgt', 'aa': 'fsyclimvptahqnkdewrg'}
+INVALID = 255
+# Longest kmers whose codes fit in an int64
+MAX_K = {'dna': 31, 'aa': 14}
+# Candidate dtypes for kmer counts, smallest first
+COUNT_DTYPES = [np.uint8, np.uint16, np.uint32]
+SIGNED_COUNT_DTYPES = [np.int8, np.int16, np.int32]
+# Largest dna k whose column lookup table is kept in memory (4^k int32 entries)
+TABLE_MAX_K = 10
+# Added to kmer codes before hashing so code 0 does not hash to column 0
+HASH_SEED = 0x9E3779B97F4A7C15
+
+_lookups = {}
+_col_tables = {}
+
+
+def gen_lookup(mode='dna'):
+    """
+    Generate a byte to code lookup table for an alphabet
+    Params:
+        mode....'dna' or 'aa'
+    Returns:
+        256 entry uint8 array mapping characters of either case to their code,
+        every other byte maps to INVALID
+    """
+    table = np.empty(256, dtype=np.uint8)
+    table.fill(INVALID)
+    for i, c in enumerate(ALPHABETS[mode]):
+        table[ord(c)] = i
+        table[ord(c.upper())] = i
+    return table
+
+
+def encode(seq, mode='dna'):
+    """
+    Map a sequence to an array of integer codes
+    Params:
+        seq.....dna or amino acid sequence, as a string or a uint8 byte array
+        mode....'dna' or 'aa'
+    Returns:
+        uint8 code array, INVALID where the character is not in the alphabet
+    """
+    if mode not in _lookups:
+        _lookups[mode] = gen_lookup(mode)
+    if not isinstance(seq, np.ndarray):
+        seq = np.frombuffer(seq, dtype=np.uint8)
+    return _lookups[mode][seq]
+
+
+def sliding_windows(codes, k):
+    """
+    Strided (n-k+1)xk view of every window of a code array
+    Params:
+        codes...uint8 code array
+        k.......length of kmer
+    Returns:
+        Read only window view and a mask of windows without INVALID codes
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty((0, k), dtype=codes.dtype), np.empty(0, dtype=bool)
+    step = codes.strides[0]
+    windows = as_strided(codes, shape=(n, k), strides=(step, step))
+    bad = np.concatenate([[0], np.cumsum(codes == INVALID)])
+    valid = bad[k:] == bad[:n]
+    return windows, valid
+
+
+def kmer_codes(codes, k, base):
+    """
+    Rolling base-n integer code of every valid window
+    Params:
+        codes...uint8 code array
+        k.......length of kmer
+        base....alphabet size
+    Returns:
+        int64 code for each window, most significant character first
+    """
+    windows, valid = sliding_windows(codes, k)
+    powers = base ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    return windows[valid].dot(powers)
+
+
+def reverse_complement_codes(codes, k):
+    """
+    Reverse complement of base-4 encoded dna kmers with bit operations
+    Params:
+        codes...int64 kmer codes
+        k.......length of kmer
+    Returns:
+        int64 codes of the reverse complements
+    """
+    # complement every base (a<->t, c<->g is code ^ 3), then reverse the order
+    # of the 2 bit groups in the 64 bit word and shift the kmer back down
+    x = np.asarray(codes).astype(np.uint64) ^ np.uint64(4 ** k - 1)
+    x = ((x >> np.uint64(2)) & np.uint64(0x3333333333333333)) | \
+        ((x & np.uint64(0x3333333333333333)) << np.uint64(2))
+    x = ((x >> np.uint64(4)) & np.uint64(0x0F0F0F0F0F0F0F0F)) | \
+        ((x & np.uint64(0x0F0F0F0F0F0F0F0F)) << np.uint64(4))
+    x = x.byteswap()
+    return (x >> np.uint64(64 - 2 * k)).astype(np.int64)
+
+
+def canonical_codes(codes, k):
+    """
+    Bin dna kmers with their reverse complements
+    Params:
+        codes...int64 kmer codes
+        k.......length of kmer
+    Returns:
+        min(code, reverse complement code) for each kmer
+    """
+    return np.minimum(codes, reverse_complement_codes(codes, k))
+
+
+def num_columns(k, mode='dna'):
+    """
+    Width of the feature matrix for a given k
+    Params:
+        k......length of kmer
+        mode...'dna' or 'aa'
+    Returns:
+        Number of canonical kmers for dna, all kmers for aa
+    """
+    if mode == 'dna':
+        return (4 ** k + (2 ** k if k % 2 == 0 else 0)) // 2
+    return len(ALPHABETS[mode]) ** k
+
+
+def hashed(k, mode='dna', hash_bits=0):
+    """
+    Whether kmers are hashed, only when the kmer space is wider than 2^hash_bits
+    Params:
+        k...........length of kmer
+        mode........'dna' or 'aa'
+        hash_bits...log2 of the hashed width, 0 never hashes
+    """
+    return hash_bits > 0 and num_columns(k, mode) > 2 ** hash_bits
+
+
+def feature_width(k, mode='dna', hash_bits=0):
+    """
+    Number of feature columns, hashed or not
+    Params:
+        k...........length of kmer
+        mode........'dna' or 'aa'
+        hash_bits...log2 of the hashed width, 0 never hashes
+    """
+    if hashed(k, mode, hash_bits):
+        return 2 ** hash_bits
+    return num_columns(k, mode)
+
+
+def vocab_info(k, mode='dna', hash_bits=0, stats=None):
+    """
+    Describe the column layout of a kmer feature matrix, stored in place of a
+    materialized kmer to column dictionary
+    Params:
+        k...........length of kmer
+        mode........'dna' or 'aa'
+        hash_bits...log2 of the hashed width, 0 never hashes
+        stats.......collision statistics of a hashed matrix from count_codes
+    Returns:
+        Dictionary with the alphabet, k, whether complements are binned and width
+    """
+    vocab = {'mode': mode, 'alphabet': ALPHABETS[mode], 'k': k,
+             'canonical': mode == 'dna', 'ncols': feature_width(k, mode, hash_bits)}
+    if hashed(k, mode, hash_bits):
+        vocab.update({'hash_bits': hash_bits, 'signed': True, 'hash_seed': HASH_SEED})
+        if stats is not None:
+            vocab.update(stats)
+    return vocab
+
+
+def gen_column_table(k):
+    """
+    Map every base-4 dna kmer code to its feature column, binning complements
+    together in the same order as preprocess.gen_vocab
+    Params:
+        k....length of kmer
+    Returns:
+        int32 array of length 4^k
+    """
+    if k not in _col_tables:
+        codes = np.arange(4 ** k, dtype=np.int64)
+        canon = canonical_codes(codes, k)
+        rank = np.cumsum(codes == canon) - 1
+        _col_tables[k] = rank[canon].astype(np.int32)
+    return _col_tables[k]
+
+
+def _pair_counts(xa, xb, a, b, j):
+    """
+    Assignment counts of one (position, mirrored position) pair of a kmer y
+    whose digits before j match x, digit j is below x[j] and the rest are free
+    Returns:
+        (# with y[a] + y[b] == 3, # with y[a] + y[b] < 3, # of assignments)
+    """
+    if a == b:
+        if a < j:
+            return 0, (xa <= 1).astype(np.int64), 1
+        if a == j:
+            return 0, np.minimum(xa, 2), xa
+        return 0, 2, 4
+    if b < j:
+        return (xa + xb == 3).astype(np.int64), (xa + xb < 3).astype(np.int64), 1
+    if b == j:
+        return (3 - xa < xb).astype(np.int64), np.minimum(xb, 3 - xa), xb
+    if a < j:
+        return 1, 3 - xa, 4
+    if a == j:
+        return xa, 3 * xa - xa * (xa - 1) // 2, 4 * xa
+    return 4, 6, 16
+
+
+def canonical_rank(codes, k):
+    """
+    Column of canonical dna kmers without a lookup table. The column of a
+    canonical kmer x is the number of canonical kmers y < x, counted digit by
+    digit: y first drops below x at some position j, and y <= revcomp(y) is
+    decided by the outermost mirrored pair of positions whose digits are not
+    complements.
+    Params:
+        codes...int64 canonical kmer codes
+        k.......length of kmer
+    Returns:
+        int64 column index for each code
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    if k <= TABLE_MAX_K:
+        return gen_column_table(k)[codes].astype(np.int64)
+
+    digits = [(codes >> (2 * (k - 1 - i))) & 3 for i in range(k)]
+    npairs = (k + 1) // 2
+    rank = np.zeros(len(codes), dtype=np.int64)
+    for j in range(k):
+        pairs = [_pair_counts(digits[p], digits[k - 1 - p], p, k - 1 - p, j)
+                 for p in range(npairs)]
+        after = [1] * npairs
+        for p in range(npairs - 2, -1, -1):
+            after[p] = after[p + 1] * pairs[p + 1][2]
+        before = 1
+        for p in range(npairs):
+            eq, lt, tot = pairs[p]
+            rank += before * lt * after[p]
+            before = before * eq
+        rank += before
+    return rank
+
+
+def hash_columns(codes, bits):
+    """
+    Signed feature hash of kmer codes with the splitmix64 finalizer
+    Params:
+        codes...int64 kmer codes
+        bits....log2 of the number of columns
+    Returns:
+        Column in [0, 2^bits) and a +1/-1 sign for each code, from disjoint bits
+        of the hash
+    """
+    x = np.asarray(codes).astype(np.uint64) + np.uint64(HASH_SEED)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    x = x ^ (x >> np.uint64(31))
+    cols = (x & np.uint64(2 ** bits - 1)).astype(np.int64)
+    signs = 1 - 2 * (x >> np.uint64(63)).astype(np.int64)
+    return cols, signs
+
+
+def hash_counts(kcodes, counts, bits, stats=None):
+    """
+    Fold distinct kmers and their counts into hashed columns
+    Params:
+        kcodes...distinct kmer codes
+        counts...count of each kmer
+        bits.....log2 of the number of columns
+        stats....dictionary accumulating 'kmers', 'collisions' (kmers sharing a
+                 column with another kmer of the row) and 'cancelled' (columns
+                 whose signed counts summed to 0)
+    Returns:
+        Sorted column indices and their signed counts
+    """
+    cols, signs = hash_columns(kcodes, bits)
+    cols, inverse = np.unique(cols, return_inverse=True)
+    values = np.bincount(inverse, weights=signs * counts, minlength=len(cols)).astype(np.int64)
+    keep = values != 0
+    if stats is not None:
+        stats['kmers'] += len(kcodes)
+        stats['collisions'] += len(kcodes) - len(cols)
+        stats['cancelled'] += len(cols) - int(keep.sum())
+    return cols[keep], values[keep]
+
+
+def code_columns(codes, k, mode='dna'):
+    """
+    Feature column of every valid kmer in an encoded sequence
+    Params:
+        codes...uint8 code array from encode
+        k.......length of kmer
+        mode....'dna' or 'aa'
+    Returns:
+        Column index for each kmer occurrence
+    """
+    kcodes = kmer_codes(codes, k, len(ALPHABETS[mode]))
+    if mode == 'dna':
+        return canonical_rank(canonical_codes(kcodes, k), k)
+    return kcodes
+
+
+def count_codes(codes, k, mode='dna', hash_bits=0, stats=None):
+    """
+    Count kmers of an encoded sequence as one sparse row
+    Params:
+        codes.......uint8 code array from encode
+        k...........length of kmer
+        mode........'dna' or 'aa'
+        hash_bits...hash kmers into 2^hash_bits signed columns when the kmer
+                    space is wider, 0 never hashes
+        stats.......collision statistics accumulated by hash_counts
+    Returns:
+        Sorted column indices and their counts
+    """
+    if k > MAX_K[mode]:
+        raise ValueError("%s kmers longer than %d do not fit in int64 codes" % (mode, MAX_K[mode]))
+    kcodes = kmer_codes(codes, k, len(ALPHABETS[mode]))
+    if len(kcodes) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if mode == 'dna':
+        kcodes = canonical_codes(kcodes, k)
+    kcodes, counts = np.unique(kcodes, return_counts=True)
+    if hashed(k, mode, hash_bits):
+        return hash_counts(kcodes, counts, hash_bits, stats)
+    if mode == 'dna':
+        # rank only the distinct canonical kmers, rank is monotonic so columns stay sorted
+        return canonical_rank(kcodes, k), counts
+    return kcodes, counts
+
+
+def kmer_columns(seq, k, mode='dna'):
+    """
+    Feature column of every valid kmer in a sequence
+    Params:
+        seq....dna or amino acid sequence
+        k......length of kmer
+        mode...'dna' or 'aa'
+    Returns:
+        Column index for each kmer occurrence
+    """
+    return code_columns(encode(seq, mode), k, mode)
+
+
+def count_kmers(seq, k, mode='dna', hash_bits=0):
+    """
+    Count kmers of a sequence as one sparse row
+    Params:
+        seq.........dna or amino acid sequence
+        k...........length of kmer
+        mode........'dna' or 'aa'
+        hash_bits...log2 of the hashed width, 0 never hashes
+    Returns:
+        Sorted column indices and their counts
+    """
+    return count_codes(encode(seq, mode), k, mode, hash_bits)
+
+
+def count_kmers_multi(seq, ks, mode='dna', hash_bits=0):
+    """
+    Count kmers for several k in one pass over a sequence
+    Params:
+        seq.........dna or amino acid sequence
+        ks..........lengths of kmers
+        mode........'dna' or 'aa'
+        hash_bits...log2 of the hashed width, 0 never hashes
+    Returns:
+        List of (columns, counts) pairs, one per k
+    """
+    codes = encode(seq, mode)
+    return [count_codes(codes, k, mode, hash_bits) for k in ks]
+
+
+def stack_rows(rows):
+    """
+    Stack sparse rows into one csr fragment
+    Params:
+        rows...(columns, counts) for each sequence
+    Returns:
+        indptr, indices and data arrays of the fragment
+    """
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(cols) for cols, counts in rows])
+    if indptr[-1] == 0:
+        return indptr, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    indices = np.concatenate([cols for cols, counts in rows])
+    data = np.concatenate([counts for cols, counts in rows])
+    return indptr, indices, data
+
+
+def compact_counts(counts, max_dtype=np.uint32, signed=False):
+    """
+    Store counts in the smallest dtype that holds the largest one
+    Params:
+        counts......kmer counts
+        max_dtype...widest dtype allowed, larger counts saturate at its maximum
+        signed......use signed dtypes, for hashed counts, of at most the width
+                    of max_dtype
+    Returns:
+        Compacted counts and a dictionary of dtype and saturation statistics
+    """
+    counts = np.asarray(counts)
+    top = int(np.abs(counts).max()) if len(counts) else 0
+    dtypes = SIGNED_COUNT_DTYPES if signed else COUNT_DTYPES
+    for dtype in dtypes:
+        if top <= np.iinfo(dtype).max or np.dtype(dtype).itemsize >= np.dtype(max_dtype).itemsize:
+            break
+    info = np.iinfo(dtype)
+    stats = {'dtype': np.dtype(dtype).name, 'max': top,
+             'saturated': int(np.sum((counts > info.max) | (counts < info.min))),
+             'over_int8': int(np.sum(np.abs(counts) > np.iinfo(np.int8).max))}
+    return np.clip(counts, info.min, info.max).astype(dtype), stats
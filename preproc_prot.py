@@ -2,9 +2,9 @@ from scipy.sparse import csr_matrix
 import numpy as np
 import re
 from collections import Counter, defaultdict
-import networkx as nx
 import pandas as pd
 import math
+import go_index
 
 def process_raw_seqs():
     print "loading data"
@@ -26,54 +26,51 @@ def process_raw_seqs():
 
 
 def construct_dag():
-    Gs = {'m': nx.DiGraph(), 'c': nx.DiGraph(), 'b': nx.DiGraph()}
-    print "Loading GO data"
-    file = "data/go-basic.obo"
-    with open (file, 'r') as f:
-        terms = f.read().split("[Term]")
-
-    alt_dict = {}
-
-    for term in terms:
-        obs = re.search("is_obsolete: true", term)
-        if not obs:
-            id = re.match("id: GO:\d+", term.strip()).group(0)[4:]
-            alts = re.findall("alt_id: GO:\d+", term)
-            category = re.search("namespace: \w", term).group(0)[-1]
-            if alts:
-                for alt in alts:
-                    alt_dict[alt[8:]] = id
-
-            Gs[category].add_node(id)
-            is_as = re.findall("is_a: GO:\d+", term)
-            Gs[category].add_edges_from([(x[6:], id) for x in is_as if x])
-            part_ofs = re.findall("part_of GO:\d+", term)
-            Gs[category].add_edges_from([(x[8:], id) for x in part_ofs if x])
-
-    for G in Gs.values():
-        print G.number_of_edges()
-        print G.number_of_nodes()
-        print [n for n,d in G.in_degree().items() if d==0]
-
-    return Gs, alt_dict
+    """
+    GO ontology as an integer id index with its ancestor closure, parsed from
+    data/go-basic.obo once and loaded from data/go_index.npz after that
+    Returns:
+        go_index.GoIndex
+    """
+    return go_index.load_go_index()
 
 
-def add_parents(G, data, alt_dict):
-    for row in data:
+def add_parents(go, data):
+    """
+    Extend the GO terms of each row with all their ancestors, found for every
+    row at once by one sparse product with the ancestor closure
+    Params:
+        go.....go_index.GoIndex
+        data...rows of [sequence, list of GO terms], terms are extended in place
+    """
+    rows = []
+    cols = []
+    for x, row in enumerate(data):
+        ids = go.term_ids(row[1])
+        ids = ids[ids >= 0]
+        rows.extend([x] * len(ids))
+        cols.extend(ids)
+    labels = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(data), len(go)))
+    labels = go.propagate(labels)
+
+    for x, row in enumerate(data):
         terms = row[1]
-        ancs = []
-        for term in terms:
-            if G.has_node(term):
-                a = G.predecessors(term)
-            elif term in alt_dict:
-                a = G.predecessors(alt_dict[term])
-            ancs.extend(a)
-        terms.extend(ancs)
+        ancs = go.ids[labels.indices[labels.indptr[x]:labels.indptr[x + 1]]]
+        have = set(terms)
+        terms.extend(t for t in ancs if t not in have)
 
     return data
 
 
-def proc_cafa():
+def proc_cafa(propagate=False):
+    """
+    Read the CAFA sequences and their GO terms
+    Params:
+        propagate...also label every ancestor of each term, the true path rule
+    Returns:
+        Dataframe of sequences and csr matrix of labels
+    """
+    go = go_index.load_go_index() if propagate else None
     seqs_file = "data/uniprot_sprot_exp.fasta"
     term_file = "data/uniprot_sprot_exp.txt"
     seq_dict = {}
@@ -86,7 +83,6 @@ def proc_cafa():
             seq_dict[seq[0]] = seq[1]
 
     X = []
-    y = []
     seq_names = []
     term_dict = defaultdict(list)
     term_vocab = {}
@@ -102,14 +98,15 @@ def proc_cafa():
             if term[1] not in term_vocab:
                 term_vocab[term[1]] = len(term_vocab)
 
+    rows = []
+    cols = []
     for k,v in seq_dict.items():
-        X.append(v)
-        label_vec = [0] * len(term_vocab)
         for term in term_dict[k]:
-            label_vec[term_vocab[term]] = 1
-        y.append(label_vec)
+            rows.append(len(X))
+            cols.append(term_vocab[term])
+        X.append(v)
 
-    y = csr_matrix(y)
+    y = go_index.label_matrix(rows, cols, len(X), term_vocab, go)
     X = np.array(X)
 
     cafa_df = pd.DataFrame({"aa":X})
@@ -192,7 +189,7 @@ def term_probs():
 #process_raw_seqs()
 
 #data = np.load("data/uniprot.npy")
-#dags, alts = construct_dag()
+#go = construct_dag()
 
 term_sens = term_probs()
 
@@ -200,6 +197,6 @@ term_sens = term_probs()
 
 
 
-#data = add_parents(go_dag, data, alts)
+#data = add_parents(go, data)
 #print_data_stats(data)
 
@@ -7,8 +7,19 @@ import numpy as np
 from scipy.sparse import csr_matrix, hstack
 import sys
 from time import time
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+import ctypes
 import os
+import shutil
+import argparse
+import kmers as km
+import feature_store as fs
+
+# Shared buffers attached to each pooled worker by init_worker
+shared = {}
+# Time of the last progress report
+last_report = [0.0]
 
 
 def window(seq, k=3):
@@ -104,103 +115,258 @@ def convert_labels(labels):
     return new_labels
 
 
-def work(seqnum_seq_k):
+def num_workers(workers=0):
     """ 
-    Function for workers to count kmers in parallel
+    Size the worker pool by the cpus this process is allowed to run on
     Params:
-        seqnum_seq_k...Sequence number, dna sequence and k
+        workers...Requested number of workers, 0 for all available cpus
     Returns:
-        sequence number paired with that sequences kmer counts
+        Number of worker processes to start
     """
-    seq = seqnum_seq_k[1]
-    seqnum = seqnum_seq_k[0]
-    k = seqnum_seq_k[2]
-    kmers = window(seq.lower(), k)
-    counts = Counter(kmers)
-
-    return [seqnum, counts]
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = cpu_count()
+    if workers > 0:
+        return min(workers, cpus)
+    return cpus
 
 
-def get_kmer_counts(data, k):
+def report_progress(done, total, interval=1.0):
     """ 
-    Pools workers and resequences results to match original order
+    Write completion to stderr at most once per interval and always at the end
     Params:
-        data...Dna sequences
-        k......kmer length
-    Returns:
-        kmer counts for all sequences in dataset
+        done.......Items finished
+        total......Items overall
+        interval...Seconds between reports
     """
-    data = zip(range(len(data)), data, [k]*len(data))
-    pool = Pool(processes=100)
+    now = time()
+    if done >= total or now - last_report[0] >= interval:
+        last_report[0] = now
+        sys.stderr.write('\rdone {0:%}'.format(float(done) / total))
 
-    res = [None] * len(data)
 
-    for i, r in enumerate(pool.imap_unordered(work, data)):
-        res[i] = r
-        sys.stderr.write('\rdone {0:%}'.format(float(i+1) / len(data)))
+def shared_array(ctype, size):
+    """ 
+    Allocate a zeroed array in shared memory that pooled workers inherit
+    Params:
+        ctype...ctypes element type
+        size....number of elements
+    Returns:
+        Shared buffer and a numpy view of it
+    """
+    buf = RawArray(ctype, max(int(size), 1))
+    return buf, np.ctypeslib.as_array(buf)[:size]
 
-    res = np.array(res)
-    indices = np.array(res[:,0],dtype=int)
-    data = np.array(res[:,1])
-    counts = data[indices]
 
-    return counts
+def init_worker(seqs, offsets, ks, mode, slot_ptrs, indices, counts, hash_bits=0):
+    """ 
+    Attach a worker to the shared sequence and output buffers
+    Params:
+        seqs........Concatenated sequence bytes
+        offsets.....Start of each sequence in seqs, plus the total length
+        ks..........kmer lengths
+        mode........'dna' or 'aa'
+        slot_ptrs...For each k, first output slot reserved for each sequence
+        indices.....For each k, output buffer for kmer columns
+        counts......For each k, output buffer for kmer counts
+        hash_bits...log2 of the hashed width of wide kmer spaces, 0 never hashes
+    """
+    shared['seqs'] = np.ctypeslib.as_array(seqs)
+    shared['offsets'] = np.ctypeslib.as_array(offsets)
+    shared['ks'] = ks
+    shared['mode'] = mode
+    shared['slot_ptrs'] = [np.ctypeslib.as_array(b) for b in slot_ptrs]
+    shared['indices'] = [np.ctypeslib.as_array(b) for b in indices]
+    shared['counts'] = [np.ctypeslib.as_array(b) for b in counts]
+    shared['hash_bits'] = hash_bits
 
 
-def featurize_data(data, k=3, mode='dna'):
+def work(start_end):
     """ 
-    Featurize sequences and index labels
+    Function for workers to count kmers in parallel, sequences are read from and
+    counts written to shared memory so only row numbers are pickled
     Params:
-        file....Delimited data file
+        start_end...First and one past last sequence number of a batch
+    Returns:
+        first sequence number paired with the number of kmers written for each sequence and k,
+        rows of a batch are written back to back from the batch's first slot, and the hash
+        collision statistics of each k
     """
+    start = start_end[0]
+    end = start_end[1]
+    seqs = shared['seqs']
+    offsets = shared['offsets']
+    ks = shared['ks']
+    mode = shared['mode']
+    nnz = np.zeros((len(ks), end - start), dtype=np.int64)
+    pos = [shared['slot_ptrs'][x][start] for x in range(len(ks))]
+    stats = [{'kmers': 0, 'collisions': 0, 'cancelled': 0} for k in ks]
+
+    for i in range(start, end):
+        codes = km.encode(seqs[offsets[i]:offsets[i+1]], mode)
+        for x in range(len(ks)):
+            cols, counts = km.count_codes(codes, ks[x], mode, shared['hash_bits'], stats[x])
+            n = len(cols)
+            shared['indices'][x][pos[x]:pos[x]+n] = cols
+            shared['counts'][x][pos[x]:pos[x]+n] = counts
+            pos[x] += n
+            nnz[x, i-start] = n
+
+    return [start, nnz, stats]
+
+
+def get_kmer_counts(data, ks, mode='dna', workers=0, batch_size=0, hash_bits=0):
+    """ 
+    Pools workers over contiguous batches of sequences held in shared memory
+    Params:
+        data.........Dna sequences
+        ks...........kmer lengths, every sequence is counted for all of them at once
+        mode.........'dna' or 'aa'
+        workers......Number of worker processes, 0 for all available cpus
+        batch_size...Sequences per task, 0 to give each worker about 4 batches
+        hash_bits....Hash kmer spaces wider than 2^hash_bits, 0 never hashes
+    Returns:
+        (batches, row nnz, slot pointers, indices, counts, hash stats) for each k, rows of
+        a batch are stored back to back from the slot of its first sequence
+    """
+    workers = num_workers(workers)
+    nseqs = len(data)
+    lens = np.array([len(seq) for seq in data], dtype=np.int64)
+
+    seq_buf, seqs = shared_array(ctypes.c_uint8, lens.sum())
+    if nseqs:
+        seqs[:] = np.frombuffer("".join(data), dtype=np.uint8)
+    offset_buf, offsets = shared_array(ctypes.c_int64, nseqs + 1)
+    offsets[1:] = np.cumsum(lens)
+
+    # A sequence has at most one nonzero per kmer window and per column
+    slot_bufs, slot_ptrs, index_bufs, indices, count_bufs, counts = [], [], [], [], [], []
+    for k in ks:
+        slots = np.minimum(np.maximum(lens - k + 1, 0), km.feature_width(k, mode, hash_bits))
+        buf, ptr = shared_array(ctypes.c_int64, nseqs + 1)
+        ptr[1:] = np.cumsum(slots)
+        slot_bufs.append(buf)
+        slot_ptrs.append(ptr)
+        buf, arr = shared_array(ctypes.c_int64, ptr[-1])
+        index_bufs.append(buf)
+        indices.append(arr)
+        # signed so hashed counts fit as well
+        buf, arr = shared_array(ctypes.c_int32, ptr[-1])
+        count_bufs.append(buf)
+        counts.append(arr)
+
+    # Build the dna column tables once, forked workers share them instead of
+    # each building its own 4^k copy
+    for k in ks:
+        if mode == 'dna' and k <= km.TABLE_MAX_K and not km.hashed(k, mode, hash_bits):
+            km.gen_column_table(k)
+
+    if batch_size <= 0:
+        batch_size = max(1, min(1000, nseqs // (workers * 4)))
+    batches = [(x, min(x + batch_size, nseqs)) for x in range(0, nseqs, batch_size)]
+    pool = Pool(processes=workers, initializer=init_worker,
+                initargs=(seq_buf, offset_buf, ks, mode, slot_bufs, index_bufs, count_bufs, hash_bits))
+
+    row_nnz = np.zeros((len(ks), nseqs), dtype=np.int64)
+    stats = [{'kmers': 0, 'collisions': 0, 'cancelled': 0} for k in ks]
+    done = 0
+
+    for start, nnz, batch_stats in pool.imap_unordered(work, batches):
+        row_nnz[:, start:start+nnz.shape[1]] = nnz
+        for x in range(len(ks)):
+            for key in stats[x]:
+                stats[x][key] += batch_stats[x][key]
+        done += nnz.shape[1]
+        report_progress(done, nseqs)
+
+    pool.close()
+    pool.join()
+
+    return [(batches, row_nnz[x], slot_ptrs[x], indices[x], counts[x], stats[x]) for x in range(len(ks))]
+
+
+def build_features(kmers, k, mode='dna', max_dtype=np.uint32, hash_bits=0):
+    """ 
+    Assemble batch results from the shared output buffers into a feature matrix
+    Params:
+        kmers.......(batches, row nnz, slot pointers, indices, counts, hash stats) from get_kmer_counts
+        k...........kmer length
+        mode........'dna' or 'aa'
+        max_dtype...widest count dtype, the smallest one holding the largest count is used
+        hash_bits...log2 of the hashed width the kmers were counted with
+    Returns:
+        csr feature matrix and description of its kmer columns
+    """
+    batches, row_nnz, slot_ptr, indices, counts, hash_stats = kmers
+    nrows = len(row_nnz)
+    signed = km.hashed(k, mode, hash_bits)
 
-    # labels = convert_labels(data.label)
-    # labels = data.label
-    start = time()
-    #kmers = [Counter(list(window(x.lower(), k))) for x in data.dna]
-    kmers = get_kmer_counts(data, k)
+    # Columns come straight from the arithmetic kmer index or hash, no kmer dictionary is built
+    vocab = km.vocab_info(k, mode, hash_bits, hash_stats)
+    ncols = vocab['ncols']
+    if signed:
+        print "Hashed %d distinct row kmers into %d columns, %d collisions, %d cancelled" % (
+            hash_stats['kmers'], ncols, hash_stats['collisions'], hash_stats['cancelled'])
 
-    print "\nCounted kmers for %d sequences in %d seconds" % (len(kmers), time()-start)
-    nrows = data.shape[0]
+    start = time()
+    # First pass: row extents from the per row nonzero counts
+    indptr = np.zeros(nrows+1, dtype="int32")
+    indptr[1:] = np.cumsum(row_nnz)
+    nonzero_data = indptr[-1]
+
+    # Second pass: gather every batch run out of the output buffers at once, a batch
+    # starts at the slot of its first row and its rows are stored back to back
+    firsts = np.array([b[0] for b in batches], dtype=np.int64)
+    lasts = np.array([b[1] for b in batches], dtype=np.int64)
+    shifts = slot_ptr[firsts] - indptr[firsts]
+    src = np.arange(nonzero_data, dtype=np.int64) + np.repeat(shifts, indptr[lasts] - indptr[firsts])
+    col = indices[src].astype("int32" if ncols < 2 ** 31 else "int64")
+    csr_data, stats = km.compact_counts(counts[src], max_dtype, signed)
+
+    print "Built %d x %d feature matrix with %d nonzeros in %f seconds" % (nrows, ncols, nonzero_data, time() - start)
+    print "Stored counts as %s, max count %d, %d counts above int8 range, %d saturated" % (
+        stats['dtype'], stats['max'], stats['over_int8'], stats['saturated'])
+    features = csr_matrix((csr_data, col, indptr), shape=(nrows, ncols))
+    return features, vocab
 
-    if mode == 'dna':
-        vocab = gen_vocab(k)
-        ncols = len(vocab) / 2 if k % 2 == 1 else (len(vocab) + 2 ** k) / 2
-    else:
-        vocab = gen_vocab(k, 'aa')
-        ncols = len(vocab)
 
+def featurize_multi(data, ks, mode='dna', workers=0, max_dtype=np.uint32, hash_bits=0):
+    """ 
+    Featurize sequences for several kmer lengths with a single pass over the data
+    Params:
+        data........Sequences
+        ks..........kmer lengths
+        mode........'dna' or 'aa'
+        workers.....Number of worker processes, 0 for all available cpus
+        max_dtype...widest count dtype, larger counts saturate
+        hash_bits...Hash kmer spaces wider than 2^hash_bits into that many signed
+                    columns, 0 never hashes
+    Returns:
+        (features, vocab) pair for each k
+    """
     start = time()
-    print "Generated vocab for complements in %d seconds" % (time() - start)
-    # comb_kmers = combine_complements(kmers, comps)
+    kmers = get_kmer_counts(data, ks, mode, workers, hash_bits=hash_bits)
 
-    # features = normalize_tfidf(vocab, comb_kmers)
-    nonzero_data = 0
-    print "Counting nonzero data"
-    for kmer in kmers:
-        nonzero_data += len(kmer)
+    print "\nCounted %s mers for %d sequences in %d seconds" % (
+        ", ".join(str(k) for k in ks), len(data), time()-start)
 
-    indptr = np.zeros(nrows+1, dtype="int32")
-    col = np.empty(nonzero_data, dtype="int32")
-    csr_data = np.empty(nonzero_data, dtype="int8")
-    print "Bulding feature matrix"
-    #features = csr_matrix((nrows, ncols))
-    data_counter = 0
-    for x in range(nrows):
-        sys.stderr.write('\rdone {0:%}'.format(float(x + 1) / nrows))
-        counts = kmers[x]
-        for k, v in counts.items():
-            col[data_counter] = vocab[k]
-            csr_data[data_counter] = v
-            data_counter += 1
-        indptr[x+1] = data_counter
-
-    #print "Size of sparse data vector is %f (mbs)" % (float(sys.getsizeof(csr_data)) / 1024 ** 2)
-
-    #print("Constructing sparse matrix")
-    features = csr_matrix((csr_data, col, indptr), shape=(nrows, ncols))
-    # normalize(features, copy=True)
-    return features, vocab
+    return [build_features(kmers[x], ks[x], mode, max_dtype, hash_bits) for x in range(len(ks))]
+
+
+def featurize_data(data, k=3, mode='dna', workers=0, max_dtype=np.uint32, hash_bits=0):
+    """ 
+    Featurize sequences and index labels
+    Params:
+        data........Sequences
+        k...........kmer length
+        mode........'dna' or 'aa'
+        workers.....Number of worker processes, 0 for all available cpus
+        max_dtype...widest count dtype, larger counts saturate
+        hash_bits...Hash kmer spaces wider than 2^hash_bits into that many signed
+                    columns, 0 never hashes
+    """
+    return featurize_multi(data, [k], mode, workers, max_dtype, hash_bits)[0]
 
 
 def save_sparse_csr(filename,array, labels, vocab):
@@ -210,24 +376,34 @@ def save_sparse_csr(filename,array, labels, vocab):
         filename...save path
         array......csr matrix
         labels.....ordered true labels
-        vocab......maps kmer to feature vector index
+        vocab......describes the kmer behind each feature vector index
     """
-    np.savez(filename,data = array.data ,indices=array.indices,
-             indptr =array.indptr, shape=array.shape, labels=labels, vocab=vocab)
+    fs.save_csr(filename, array, labels, vocab)
 
 
-def read_chunks(file,f,k,chunksize):
+def read_chunks(file,f,k,chunksize,workers=0,hash_bits=0,prune=0):
     c = 0
-    path ="data/feature_matrix." + f + str(k) + "/"
-    if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
+    path = "data/" + f + "/feature_matrix." + str(k) + ".csr"
+    final_path = path
+    if prune > 0:
+        # the unpruned matrix only exists on disk, until the pruned copy is written
+        path = path + ".unpruned"
+    data_dtype = np.int16 if km.hashed(k, 'dna', hash_bits) else np.uint16
+    writer = fs.CsrWriter(path, km.feature_width(k, 'dna', hash_bits), data_dtype, km.vocab_info(k, 'dna', hash_bits))
     for data in pd.read_csv(file, chunksize=chunksize, names=["label", "dna"], usecols=[0, 7], delimiter='\t', header=0):
         labels = data.label
-        features, vocab = featurize_data(data, k)
-        # print "There are %d unique kmers" % len(features[0])
-        print "\nSize of sparse matrix chunk %d is %f (mbs)" % (c, float(sys.getsizeof(features)) / 1024 ** 2)
-        save_sparse_csr(path + "chunk." + str(c) + ".csr", features, labels, vocab)
+        features, vocab = featurize_data(data.dna, k, workers=workers, max_dtype=np.uint16, hash_bits=hash_bits)
+        writer.append(features, labels)
+        # collision statistics add up over chunks
+        for key in ['kmers', 'collisions', 'cancelled']:
+            if key in vocab:
+                writer.vocab[key] = writer.vocab.get(key, 0) + vocab[key]
+        print "\nAppended chunk %d, %d rows and %d nonzeros written to %s" % (c, writer.nrows, writer.nnz, path)
         c += 1
+    writer.close()
+    if prune > 0:
+        fs.prune_store(path, final_path, prune)
+        shutil.rmtree(path)
 
 
 def featurize_nuc_counts(data):
@@ -242,7 +418,7 @@ def featurize_aa_counts(data):
     return csr_matrix(np.array(M))
 
 
-def read_cafa(file):
+def read_cafa(file, workers=0):
     print "Reading cafa dataframe"
     f = "cafa"
     data = pd.read_csv(file,  header=0)
@@ -259,25 +435,22 @@ def read_cafa(file):
         if 'O' in data.aa[x]:
             data.aa[x] = data.aa[x].replace("O", "")
 
-    print "generating aa 2mer features"
-    aa_features, aa_vocab = featurize_data(data.aa, 2, 'aa')
-    print "generating aa 3mer features"
-    aa_features3, aa_vocab3 = featurize_data(data.aa, 3, 'aa')
-
-    aa_features4, aa_vocab4 = featurize_data(data.aa, 4, 'aa')
+    print "generating aa 2, 3 and 4mer features"
+    (aa_features, aa_vocab), (aa_features3, aa_vocab3), (aa_features4, aa_vocab4) = \
+        featurize_multi(data.aa, [2, 3, 4], 'aa', workers)
     aa_counts = featurize_aa_counts(data.aa)
     aa_lens = csr_matrix(np.array([len(seq) for seq in data.aa]).reshape((len(data.aa), 1)))
     aa_counts = hstack([aa_counts, aa_lens], format='csr')
     if not os.path.exists("data/cafa"):
         os.makedirs("data/cafa")
 
-    save_sparse_csr("data/" + f + "/feature_matrix.aa1.csr", aa_counts, [], aa_vocab)
+    save_sparse_csr("data/" + f + "/feature_matrix.aa1.csr", aa_counts, [], [])
     save_sparse_csr("data/" + f + "/feature_matrix.aa2.csr", aa_features, [], aa_vocab)
     save_sparse_csr("data/" + f + "/feature_matrix.aa3.csr", aa_features3, [], aa_vocab3)
     save_sparse_csr("data/" + f + "/feature_matrix.aa4.csr", aa_features4, [], aa_vocab4)
 
 
-def read_whole(file,f,k):
+def read_whole(file,f,k,workers=0,hash_bits=0):
     if f == 'core':
         data = pd.read_csv(file, names=["label", "dna", "aa"], usecols=[1, 5, 6], delimiter='\t', header=0)
         for x in range(len(data.aa)):
@@ -291,15 +464,10 @@ def read_whole(file,f,k):
         data = pd.read_csv(file, names=["label", "aa", "dna"], usecols=[0, 6, 7], delimiter='\t', header=0)
     labels = data.label
 
-    features3, vocab = featurize_data(data.dna, 3)
-    features5, vocab = featurize_data(data.dna, 5)
-    features10, vocab = featurize_data(data.dna, 10)
-    print "generating aa 2mer features"
-    aa_features, aa_vocab = featurize_data(data.aa, 2, 'aa')
-    print "generating aa 3mer features"
-    aa_features3, aa_vocab3 = featurize_data(data.aa, 3, 'aa')
-
-    aa_features4, aa_vocab3 = featurize_data(data.aa, 4, 'aa')
+    (features3, vocab3), (features5, vocab5), (features10, vocab10) = featurize_multi(data.dna, [3, 5, 10], workers=workers, hash_bits=hash_bits)
+    print "generating aa 2, 3 and 4mer features"
+    (aa_features, aa_vocab), (aa_features3, aa_vocab3), (aa_features4, aa_vocab4) = \
+        featurize_multi(data.aa, [2, 3, 4], 'aa', workers)
 
     #aa_features, aa_vocab = featurize_data(data.aa, k)
 
@@ -314,23 +482,23 @@ def read_whole(file,f,k):
     #features = hstack([features, seq_lens], format='csr')
 
     aa_counts = hstack([aa_counts, aa_lens], format='csr')
-    save_sparse_csr("data/" + f + "/feature_matrix.aa1.csr", aa_counts, labels, vocab)
-    save_sparse_csr("data/" + f + "/feature_matrix.aa2.csr", aa_features, labels, vocab)
-    save_sparse_csr("data/" + f + "/feature_matrix.aa3.csr", aa_features3, labels, vocab)
-    save_sparse_csr("data/" + f + "/feature_matrix.aa4.csr", aa_features4, labels, vocab)
+    save_sparse_csr("data/" + f + "/feature_matrix.aa1.csr", aa_counts, labels, [])
+    save_sparse_csr("data/" + f + "/feature_matrix.aa2.csr", aa_features, labels, aa_vocab)
+    save_sparse_csr("data/" + f + "/feature_matrix.aa3.csr", aa_features3, labels, aa_vocab3)
+    save_sparse_csr("data/" + f + "/feature_matrix.aa4.csr", aa_features4, labels, aa_vocab4)
 
     #print features.shape
     #seq_lens = seq_lens.reshape((seq_lens.shape[0],1))
     #print "There are %d unique kmers" % len(features[0])
     nuc_features = hstack([nuc_features,seq_lens], format='csr')
     #print "\nSize of sparse matrix is %f (mbs)" % (float(sys.getsizeof(features))/1024**2)
-    save_sparse_csr("data/" + f + "/feature_matrix.1.csr", nuc_features, labels, vocab)
-    save_sparse_csr("data/" + f + "/feature_matrix.3.csr", features3, labels, vocab)
-    save_sparse_csr("data/" + f + "/feature_matrix.5.csr", features5, labels, vocab)
-    save_sparse_csr("data/" + f + "/feature_matrix.10.csr", features10, labels, vocab)
+    save_sparse_csr("data/" + f + "/feature_matrix.1.csr", nuc_features, labels, [])
+    save_sparse_csr("data/" + f + "/feature_matrix.3.csr", features3, labels, vocab3)
+    save_sparse_csr("data/" + f + "/feature_matrix.5.csr", features5, labels, vocab5)
+    save_sparse_csr("data/" + f + "/feature_matrix.10.csr", features10, labels, vocab10)
 
 
-def main(fn='cafa', k=3, chunksize=100000):
+def main(fn='cafa', k=3, chunksize=100000, workers=0, hash_bits=0, prune=0):
     start = time()
     k = int(k)
     chunksize = int(chunksize)
@@ -340,29 +508,37 @@ def main(fn='cafa', k=3, chunksize=100000):
     if fn == "lg":
         file = "data/rep.1000ec.pgf.seqs.filter"
         if chunksize > 0:
-            read_chunks(file, fn, k, chunksize)
+            read_chunks(file, fn, k, chunksize, workers, hash_bits, prune)
         else:
-            read_whole(file, fn, k)
+            read_whole(file, fn, k, workers, hash_bits)
     elif fn == "core":
         file = "data/coreseed.train.tsv"
         if chunksize > 0:
-            read_chunks(file, fn, k, chunksize)
+            read_chunks(file, fn, k, chunksize, workers, hash_bits, prune)
         else:
-            read_whole(file, fn, k)
+            read_whole(file, fn, k, workers, hash_bits)
     elif fn =="cafa":
         file = "data/cafa_df"
-        read_cafa(file)
+        read_cafa(file, workers)
     else:
         file = "data/ref.100ec.pgf.seqs.filter"
-        read_whole(file, fn, k)
+        read_whole(file, fn, k, workers, hash_bits)
 
     print "Time elapsed to build %d mers is %f" % (k, time() - start)
 
 
+def get_parser():
+    parser = argparse.ArgumentParser(description='Generate kmer feature matrices from sequence data')
+    parser.add_argument("data", nargs='?', default='cafa', type=str, help="data to featurize")
+    parser.add_argument("k", nargs='?', default=3, type=int, help="kmer length for chunked featurization")
+    parser.add_argument("chunksize", nargs='?', default=100000, type=int, help="rows per chunk, 0 to read the whole file")
+    parser.add_argument("--workers", default=0, type=int, help="number of worker processes, defaults to available cpus")
+    parser.add_argument("--prune", default=0, type=int, help="drop columns stored by at most this many rows while writing chunks")
+    parser.add_argument("--hash_bits", default=0, type=int, help="hash dna kmer spaces wider than 2^hash_bits into that many signed columns, 0 to never hash")
+    return parser
+
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        #os.chdir("/home/ngetty/examples/protein-pred")
-        args = sys.argv[1:]
-        main(args[0], args[1], args[2])
-    else:
-        main()
+    #os.chdir("/home/ngetty/examples/protein-pred")
+    args = get_parser().parse_args()
+    main(args.data, args.k, args.chunksize, args.workers, args.hash_bits, args.prune)
@@ -0,0 +1,254 @@
+import numpy as np
+import os
+import json
+import hashlib
+from sklearn.datasets import dump_svmlight_file
+import lightgbm as lgb
+import xgboost as xgb
+
+
+# sklearn wrapper arguments that are not booster parameters
+LGBM_SKLEARN_ONLY = ['n_estimators', 'silent', 'class_weight', 'importance_type']
+# LightGBM parameters fixed when a dataset is binned
+LGBM_BINNING = ['max_bin', 'subsample_for_bin', 'min_child_samples', 'random_state']
+
+
+def write_svmlight(features, labels, rows, filename, batch_rows=10000):
+    """
+    Write rows of a lazily selected feature matrix to a libsvm text file, one
+    batch of rows at a time, so the full matrix is never in memory
+    Params:
+        features.....fs.LazyCsr feature matrix
+        labels.......numeric label of every row of features
+        rows.........rows to write
+        filename.....save path
+        batch_rows...rows read at a time
+    """
+    rows = np.asarray(rows)
+    with open(filename, 'wb') as f:
+        for start in range(0, len(rows), batch_rows):
+            idx = rows[start:start + batch_rows]
+            block = features.select_rows(idx).tocsr()
+            dump_svmlight_file(block, labels[idx], f, zero_based=True)
+
+
+def lightgbm_params(clf, num_class):
+    """
+    Booster parameters of an LGBMClassifier
+    Params:
+        clf.........LGBMClassifier
+        num_class...number of classes, 2 for a binary objective
+    Returns:
+        Parameter dictionary and number of boosting rounds
+    """
+    params = clf.get_params()
+    rounds = params['n_estimators']
+    for key in LGBM_SKLEARN_ONLY:
+        params.pop(key, None)
+    params = dict((k, v) for k, v in params.items() if v is not None)
+    if 'nthread' in params:
+        # n_jobs defaults to -1 and would override an explicit nthread
+        params.pop('n_jobs', None)
+    params.update({'verbose': -1, 'two_round': True})
+    if num_class > 2:
+        params.update({'objective': 'multiclass', 'num_class': num_class})
+    else:
+        params.update({'objective': 'binary'})
+    return params, rounds
+
+
+def xgboost_params(clf, num_class, num_feature):
+    """
+    Booster parameters of an XGBClassifier
+    Params:
+        clf...........XGBClassifier
+        num_class.....number of classes, 2 for a binary objective
+        num_feature...width of the feature matrix, libsvm files only show the
+                      largest column that has a value
+    Returns:
+        Parameter dictionary and number of boosting rounds
+    """
+    params = clf.get_xgb_params()
+    params.update({'num_feature': num_feature})
+    if num_class > 2:
+        params.update({'objective': 'multi:softprob', 'num_class': num_class})
+    else:
+        params.update({'objective': 'binary:logistic'})
+    return params, clf.get_params()['n_estimators']
+
+
+def train_booster(clf, m, train_file, test_file, num_class, num_feature):
+    """
+    Train a gradient boosting model from libsvm files. LightGBM reads the file
+    twice, binning features from a sample on the first pass, and XGBoost pages
+    the rows through an on disk cache, so neither holds the raw float matrix.
+    Params:
+        clf..........XGBClassifier or LGBMClassifier holding the parameters
+        m............The model name
+        train_file...libsvm training rows
+        test_file....libsvm validation rows, used for early stopping
+        num_class....number of classes
+        num_feature..width of the feature matrix
+    Returns:
+        Trained booster
+    """
+    if m == 'LightGBM':
+        params, rounds = lightgbm_params(clf, num_class)
+        train = lgb.Dataset(train_file, params=params)
+        valid = lgb.Dataset(test_file, reference=train)
+        return lgb.train(params, train, rounds, valid_sets=[valid],
+                         early_stopping_rounds=2, verbose_eval=False)
+    params, rounds = xgboost_params(clf, num_class, num_feature)
+    train = xgb.DMatrix(train_file + '#' + train_file + '.cache')
+    valid = xgb.DMatrix(test_file + '#' + test_file + '.cache')
+    return xgb.train(params, train, rounds, evals=[(train, 'train'), (valid, 'test')],
+                     early_stopping_rounds=2, verbose_eval=False)
+
+
+def class_probabilities(probs):
+    """
+    Probability matrix of booster predictions, binary objectives only predict
+    the positive class
+    Params:
+        probs...N vector or NxC matrix of predictions
+    Returns:
+        NxC probability matrix
+    """
+    probs = np.asarray(probs)
+    if probs.ndim == 1:
+        return np.column_stack([1 - probs, probs])
+    return probs
+
+
+def predict_file(bst, m, filename):
+    """
+    Class probabilities of the rows of a libsvm file
+    Params:
+        bst........trained booster
+        m..........The model name
+        filename...libsvm rows
+    Returns:
+        NxC probability matrix
+    """
+    if m == 'LightGBM':
+        return class_probabilities(bst.predict(filename, num_iteration=bst.best_iteration))
+    data = xgb.DMatrix(filename + '#' + filename + '.cache')
+    return class_probabilities(bst.predict(data, ntree_limit=bst.best_ntree_limit))
+
+
+def dataset_key(feature_key, rows, labels=None):
+    """
+    Key of a feature set restricted to a subset of rows
+    Params:
+        feature_key...json serializable description of how the features were
+                      built, including fs.content_stamp of every file read
+        rows..........rows of the feature stores that are used
+        labels........labels of the rows, when they are part of the data
+    Returns:
+        Hex digest
+    """
+    h = hashlib.sha1(json.dumps(feature_key, sort_keys=True))
+    h.update(np.asarray(rows, dtype=np.int64).tobytes())
+    if labels is not None:
+        h.update("\n".join(str(l) for l in labels))
+    return h.hexdigest()[:16]
+
+
+def cache_dataset(clf, m, X, labels, cache_dir, data_key):
+    """
+    Save a feature matrix in a booster's binary dataset format once, so other
+    runs, models with the same binning and cross-validation folds load it
+    instead of converting the features again. LightGBM saves the binned
+    dataset. An XGBoost DMatrix holds the raw feature values, so XGBoost still
+    quantizes them in every train call and only the conversion is cached.
+    Params:
+        clf.........XGBClassifier or LGBMClassifier holding the parameters
+        m...........The model name
+        X...........feature matrix
+        labels......numeric labels
+        cache_dir...directory of cached datasets
+        data_key....key of the feature set, rows and labels from dataset_key
+    Returns:
+        Path of the cached dataset
+    """
+    if m == 'LightGBM':
+        params, rounds = lightgbm_params(clf, int(labels.max()) + 1)
+        binning = dict((k, params[k]) for k in LGBM_BINNING if k in params)
+    else:
+        binning = {}
+    h = hashlib.sha1(json.dumps([data_key, m, binning], sort_keys=True)).hexdigest()[:16]
+    path = os.path.join(cache_dir, "%s.%s.bin" % (m, h))
+    if os.path.exists(path):
+        print "Using cached %s dataset %s" % (m, path)
+        return path
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    print "Caching %s dataset to %s" % (m, path)
+    if m == 'LightGBM':
+        lgb.Dataset(X, label=labels, params=binning).construct().save_binary(path)
+    else:
+        xgb.DMatrix(X, label=labels).save_binary(path)
+    return path
+
+
+def train_cached(clf, m, data_path, train_rows, test_rows, num_class, num_feature):
+    """
+    Train a booster on rows of a cached dataset, taking the subsets by row
+    indexing of the cached dataset
+    Params:
+        clf...........XGBClassifier or LGBMClassifier holding the parameters
+        m.............The model name
+        data_path.....cached dataset from cache_dataset
+        train_rows....training rows
+        test_rows.....validation rows, used for early stopping
+        num_class.....number of classes
+        num_feature...width of the feature matrix
+    Returns:
+        Trained booster
+    """
+    if m == 'LightGBM':
+        params, rounds = lightgbm_params(clf, num_class)
+        data = lgb.Dataset(data_path, params=params)
+        train = data.subset(np.sort(train_rows))
+        valid = data.subset(np.sort(test_rows))
+        return lgb.train(params, train, rounds, valid_sets=[valid],
+                         early_stopping_rounds=2, verbose_eval=False)
+    params, rounds = xgboost_params(clf, num_class, num_feature)
+    data = xgb.DMatrix(data_path)
+    train = data.slice(list(train_rows))
+    valid = data.slice(list(test_rows))
+    return xgb.train(params, train, rounds, evals=[(train, 'train'), (valid, 'test')],
+                     early_stopping_rounds=2, verbose_eval=False)
+
+
+def predict_rows(bst, m, X):
+    """
+    Class probabilities of the rows of a feature matrix
+    Params:
+        bst...trained booster
+        m.....The model name
+        X.....feature matrix
+    Returns:
+        NxC probability matrix
+    """
+    if m == 'LightGBM':
+        return class_probabilities(bst.predict(X, num_iteration=bst.best_iteration))
+    return class_probabilities(bst.predict(xgb.DMatrix(X), ntree_limit=bst.best_ntree_limit))
+
+
+def feature_importances(bst, m, num_feature):
+    """
+    Split count importance of every feature, as the sklearn wrappers report it
+    Params:
+        bst...........trained booster
+        m.............The model name
+        num_feature...width of the feature matrix
+    Returns:
+        Importance array of length num_feature
+    """
+    if m == 'LightGBM':
+        return bst.feature_importance('split')
+    scores = np.zeros(num_feature)
+    for f, score in bst.get_score(importance_type='weight').items():
+        scores[int(f[1:])] = score
+    return scores / max(scores.sum(), 1)
@@ -0,0 +1,86 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def top_k_classes(probs, k):
+    """
+    Indices of the k most probable classes of each row, most probable first,
+    without sorting every class
+    Params:
+        probs...NxC matrix, class probabilities for each class
+        k.......number of classes to keep, capped at C
+    Returns:
+        Nxk integer matrix
+    """
+    probs = np.asarray(probs)
+    k = min(k, probs.shape[1])
+    if k < probs.shape[1]:
+        top = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(k), (probs.shape[0], 1))
+    rows = np.arange(probs.shape[0])[:, None]
+    order = np.argsort(-probs[rows, top], axis=1, kind='mergesort')
+    return top[rows, order]
+
+
+def top_k_hits(probs, y_true, ks=(1, 5), block_rows=10000):
+    """
+    Whether the true class is among the k most probable for each row, computed
+    a block of rows at a time so only block_rows x max(ks) indices are held
+    Params:
+        probs........NxC matrix, class probabilities for each class
+        y_true.......True class labels
+        ks...........values of k
+        block_rows...rows ranked at a time
+    Returns:
+        Nxlen(ks) boolean matrix
+    """
+    y_true = np.asarray(y_true).astype(np.int64)
+    kmax = max(ks)
+    hits = np.empty((len(y_true), len(ks)), dtype=bool)
+    for start in range(0, len(y_true), block_rows):
+        end = start + block_rows
+        top = top_k_classes(probs[start:end], kmax)
+        found = np.cumsum(top == y_true[start:end, None], axis=1) > 0
+        for x, k in enumerate(ks):
+            hits[start:end, x] = found[:, min(k, found.shape[1]) - 1]
+    return hits
+
+
+def top_k_accuracy(probs, y_true, ks=(1, 5), block_rows=10000):
+    """
+    Top k accuracy for several k in one pass
+    Params:
+        probs........NxC matrix, class probabilities for each class
+        y_true.......True class labels
+        ks...........values of k
+        block_rows...rows ranked at a time
+    Returns:
+        List of accuracies in the order of ks
+    """
+    if len(y_true) == 0:
+        return [0.0] * len(ks)
+    return list(top_k_hits(probs, y_true, ks, block_rows).mean(axis=0))
+
+
+def top_k_sparse(probs, k, block_rows=10000):
+    """
+    Keep only the k largest probabilities of each row
+    Params:
+        probs........NxC matrix, class probabilities for each class
+        k............nonzeros kept per row
+        block_rows...rows ranked at a time
+    Returns:
+        NxC float32 csr matrix with k entries per row
+    """
+    n, ncols = probs.shape
+    k = min(k, ncols)
+    indices = np.empty((n, k), dtype=np.int32)
+    data = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, block_rows):
+        block = np.asarray(probs[start:start + block_rows])
+        top = np.sort(top_k_classes(block, k), axis=1)
+        indices[start:start + len(block)] = top
+        data[start:start + len(block)] = block[np.arange(len(block))[:, None], top]
+    indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+    return csr_matrix((data.ravel(), indices.ravel(), indptr), shape=(n, ncols))